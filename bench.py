@@ -0,0 +1,233 @@
+#! /usr/bin/env python3
+
+import random
+from timeit import Timer
+from functions import attributes
+import table
+import shop
+import os, os.path
+from contextlib import ExitStack
+from io import TextIOWrapper, BytesIO
+from shutil import copyfileobj
+from streams import DelegateWriter
+
+@attributes(param_types=dict(seed=int))
+def main(*names, seed=0, cache=os.curdir):
+    '''Runs the named benchmarks, or all of them
+    
+    The "cache" directory is searched for pages saved by shop.py.'''
+    for name in names or BENCHMARKS:
+        BENCHMARKS[name](random.Random(seed), cache)
+
+def bench_alnum_key(rand, cache, count=20000):
+    samples = {
+        "part numbers": [part_number(rand) for _ in range(count)],
+        "prices": [price(rand) for _ in range(count)],
+        "mixed": [mixed(rand) for _ in range(count)],
+    }
+    for [name, values] in samples.items():
+        expected = sorted(values, key=reference_alnum_key)
+        if sorted(values, key=table.alnum_key) != expected:
+            raise AssertionError("alnum_key() order differs for " + name)
+        for func in (reference_alnum_key, table.alnum_key):
+            time = best_time(lambda: list(map(func, values)))
+            msg = "alnum_key {}, {}: {:.0f} keys/s"
+            print(msg.format(name, func.__name__, len(values) / time))
+            time = best_time(lambda: sorted(values, key=func))
+            msg = "alnum_key {}, {}: sorted in {:.3f} s"
+            print(msg.format(name, func.__name__, time))
+
+def best_time(func):
+    timer = Timer(func)
+    [loops, _] = timer.autorange()
+    return min(timer.repeat(3, loops)) / loops
+
+def part_number(rand):
+    template = rand.choice((
+        "{}-{}", "{0}{1}", "{2}{0}", "{2}{0}-{1}", "{2}{1}/{0}",
+        "{2}{0} {3}K{0} 1%",
+    ))
+    return template.format(
+        rand.randrange(100, 10000),
+        rand.randrange(1000, 10000),
+        "".join(rand.choices(LETTERS, k=rand.randrange(1, 5))),
+        rand.randrange(1, 100),
+    )
+
+LETTERS = "ABCDEFGHKLMNPRSTVXZ"
+
+def price(rand):
+    cents = int(10 ** rand.uniform(1, 7))
+    return "${:,}.{:02}".format(*divmod(cents, 100))
+
+def mixed(rand):
+    template = rand.choice((
+        "Pack of {}", "{} x {}mm", "{}.{}W", ".{}uF", "Reel of {},{}",
+        "Each (In a Pack of {})", "{} {} {}", "M{} x {}",
+    ))
+    return template.format(*(rand.randrange(1, 1000) for _ in range(3)))
+
+def reference_alnum_key(value):
+    '''The original version of table.alnum_key(), which should sort the same'''
+    numbers = list()
+    i = 0
+    while i < len(value):
+        if value[i].isdecimal() or value[i] == ".":
+            start = i
+            while value[i:i + 1] == "," or value[i:i + 1].isdecimal():
+                i += 1
+            whole = value[start:i].translate(table._DROP_COMMAS)
+            start = i
+            if value[i:i + 1] == ".":
+                while True:
+                    i += 1
+                    if not value[i:i + 1].isdecimal():
+                        break
+            if whole:
+                whole = int(whole)
+            else:
+                whole = 0
+            numbers.append(("0", whole, value[start:i]))
+            while value[i:i + 1].isspace():
+                i += 1
+        else:
+            numbers.append((value[i],))
+            i += 1
+    return (numbers, value)
+
+def bench_scrape_row(rand, cache):
+    rows = list()
+    for page in cached_pages(cache):
+        [table] = page.iterfind(".//table[@class='srtnListTbl']")
+        rows.extend(table.iterfind(".//tr"))
+    if not rows:
+        print("scrape_row: no saved pages found in", repr(cache))
+        return
+    expected = list(map(reference_scrape_row, rows))
+    if list(map(shop.scrape_row, rows)) != expected:
+        raise AssertionError("scrape_row() output differs")
+    for func in (reference_scrape_row, shop.scrape_row):
+        time = best_time(lambda: list(map(func, rows)))
+        msg = "scrape_row, {}: {:.1f} ms per 1000 rows"
+        print(msg.format(func.__name__, time / len(rows) * 1000 * 1e3))
+
+def bench_decode(rand, cache):
+    responses = list(cached_responses(cache))
+    if not responses:
+        print("decode: no saved pages found in", repr(cache))
+        return
+    size = 0
+    decoded = 0
+    for [header, body] in responses:
+        expected = list()
+        reference_decode(header, BytesIO(body), expected.append)
+        text = list()
+        shop.feed_text(header, BytesIO(body), text.append)
+        if "".join(text) != "".join(expected):
+            raise AssertionError("feed_text() output differs")
+        size += len(body)
+        decoded += len(shop.decompress(header, BytesIO(body)).read())
+    for func in (reference_decode, shop.feed_text):
+        def run():
+            for [header, body] in responses:
+                func(header, BytesIO(body), discard)
+        time = best_time(run)
+        msg = "decode, {}: {:.1f} MB/s received, {:.1f} MB/s decompressed"
+        print(msg.format(func.__name__, size / time / 1e6,
+            decoded / time / 1e6))
+
+def discard(text):
+    pass
+
+def reference_decode(header, response, feed):
+    '''How shop.py decoded pages before shop.feed_text()'''
+    response = shop.decompress(header, response)
+    response = TextIOWrapper(response, header.get_content_charset())
+    copyfileobj(response, DelegateWriter(feed))
+
+def cached_pages(cache):
+    '''Yields the tree of each HTML page saved by shop.get_cached()'''
+    for [header, body] in cached_responses(cache):
+        parser = shop.HtmlTreeParser()
+        shop.feed_text(header, BytesIO(body), parser.feed)
+        yield parser.close()
+
+def cached_responses(cache):
+    '''Yields the header and undecoded body saved by shop.get_cached()'''
+    for [dir, _, files] in os.walk(cache):
+        for name in files:
+            if not name.endswith(os.extsep + "mime"):
+                continue
+            with ExitStack() as cleanup:
+                with open(os.path.join(dir, name), "rb") as metadata:
+                    [header, response] = shop.read_cached(metadata, dir,
+                        cleanup)
+                yield (header, response.read())
+
+def reference_scrape_row(row):
+    '''The original version of shop.scrape_row(), which does a separate
+    search for each field'''
+    row = row.iterfind(".//td")
+    cell = next(row)
+    
+    [desc] = cell.iterfind(".//a[@class='tnProdDesc']")
+    out_row = [desc.get("href")]
+    out_row.append("".join(desc.itertext()).strip())
+    
+    pricing = None
+    for elem in cell.iterfind(".//span[1][@class]/.."):
+        if "price" in elem[0].get("class", "").split():
+            assert pricing is None
+            pricing = elem
+    pricing = iter(pricing)
+    out_row.append("".join(next(pricing).itertext()))
+    pricing = "".join(t for elem in pricing for t in elem.itertext())
+    [qty] = cell.iterfind(".//*[@class='qty']//input")
+    qty = int(qty.get("value"))
+    
+    per_item_prefix = "Each ("
+    per_item_suffix = ")"
+    if pricing == "Each":
+        out_row.extend((1, "Each", 1, qty))
+    elif pricing.startswith(per_item_prefix) \
+            and pricing.endswith(per_item_suffix):
+        pricing = pricing[len(per_item_prefix):-len(per_item_suffix)]
+        for prefix in ("In a ", "On a "):
+            if pricing.startswith(prefix):
+                pricing = pricing[len(prefix):]
+                break
+        [pricing, size] = pricing.rsplit(" of ", 1)
+        assert int(size) == qty
+        out_row.extend((1, pricing, size, 1))
+    else:
+        prefix = "1 "
+        assert pricing.startswith(prefix)
+        [pricing, size] = pricing[len(prefix):].rsplit(" of ", 1)
+        out_row.extend((size, pricing, size, qty))
+    
+    cell = next(row)
+    details = cell.iterfind(".//li")
+    for label in shop.PART_DETAILS:
+        try:
+            detail = next(details)
+        except StopIteration:
+            assert label ==  "Mfr. Part No."
+            out_row.append(None)
+        else:
+            assert "".join(detail[0].itertext()) == label
+            text = "".join(t
+                for elem in detail[1:] for t in elem.itertext())
+            out_row.append(text.strip())
+    
+    out_row.extend("".join(cell.itertext()).strip() for cell in row)
+    return out_row
+
+BENCHMARKS = {
+    "alnum_key": bench_alnum_key,
+    "scrape_row": bench_scrape_row,
+    "decode": bench_decode,
+}
+
+if __name__ == "__main__":
+    import clifunc
+    clifunc.run()
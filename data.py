@@ -12,18 +12,25 @@ import urllib.request
 from xml.etree import ElementTree
 import urllib.parse
 from misc import UnicodeMap
-from tkinter.ttk import Frame, Entry
+from tkinter.ttk import Frame, Entry, Combobox
+from tkinter.messagebox import showerror
 from xml.sax.saxutils import XMLGenerator
 from xml.sax import xmlreader
 from urllib.error import HTTPError
 import http.client
-from contextlib import closing, contextmanager
+from contextlib import closing, contextmanager, ExitStack
 import json
 from tempfile import NamedTemporaryFile
 import os, os.path
 from shutil import copystat
-from collections import OrderedDict
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor, Future
+from functools import partial
+import threading
+import queue
 import ssl
+import re
+import math
 
 ATOM_NS = "http://www.w3.org/2005/Atom"
 ATOM_PREFIX = "{" + ATOM_NS + "}"
@@ -34,10 +41,32 @@ LIST_REL = urllib.parse.urljoin(GOOGLE_SHEET_NS, "#listfeed")
 CELLS_REL = urllib.parse.urljoin(GOOGLE_SHEET_NS, "#cellsfeed")
 POST_REL = "http://schemas.google.com/g/2005#post"
 GOOGLE_SHEETX_NS = GOOGLE_SHEET_NS + "/extended"
+BATCH_NS = "http://schemas.google.com/gdata/batch"
 
+@attributes(param_types=dict(page_size=int))
 class main:
-    def __init__(self, settings="settings.csv"):
+    '''Views and edits a Google Sheets worksheet
+    
+    The list feed is downloaded --page-size rows at a time. Further
+    pages are only downloaded when scrolling near the end of the view.
+    
+    Edited cells are queued and sent together through the cells batch
+    feed, after a delay, when the queue is full, or on Control+S.
+    
+    Requests are made by worker threads, so that several can be in
+    flight while the window stays responsive. Rows with queued edits
+    are shown in blue, and rows with requests in flight in grey.
+    
+    If --replica gives an SQLite database, the downloaded rows of each
+    spreadsheet are kept in it. On the next run they are shown straight
+    away, and then only the list entries updated since are downloaded.
+    If rows or columns have been added or removed, the worksheet is
+    downloaded again.'''
+    
+    def __init__(self, settings="settings.csv", *, page_size=200,
+            replica=None):
         self.settings_file = settings
+        self.page_size = page_size
         reader = open(self.settings_file, "rt", encoding="ascii", newline="")
         with reader:
             self.settings = OrderedDict(csv.reader(reader))
@@ -50,6 +79,11 @@ class main:
         self.entry.pack(fill=tkinter.BOTH, side=tkinter.TOP)
         self.entry.bind("<Return>", self.update_cell)
         self.entry.bind("<KP_Enter>", self.update_cell)
+        self.tk.bind("<Control-s>", self.flush_edits)
+        self.tk.wm_protocol("WM_DELETE_WINDOW", self.on_close)
+        self.edits = OrderedDict()  # Text for each (item, column)
+        self.sending = dict()  # Text of edits in flight
+        self.flush_timer = None
         
         self.auth_window = tkinter.Toplevel(self.tk)
         self.auth_window.bind("<Return>", self.on_auth_enter)
@@ -70,9 +104,24 @@ class main:
         self.access.insert(0, self.settings.get("access_token", ""))
         self.client.focus_set()
         
-        with PersistentConnectionHandler(timeout=100) as connection:
-            self.session = urllib.request.build_opener(connection)
-            self.tk.mainloop()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.results = queue.Queue()  # (callback, future) for the Tk thread
+        self.in_flight = Counter()  # Requests being made for each item
+        self.generation = 0  # Results of older generations are dropped
+        with ExitStack() as self.connections:
+            self.replica = None
+            if replica is not None:
+                self.replica = self.connections.enter_context(
+                    Replica(replica))
+            with ThreadPoolExecutor(WORKERS) as self.pool:
+                self.tk.after(POLL_INTERVAL, self.poll_results)
+                self.tk.mainloop()
+        while not self.results.empty():
+            [_, future, _] = self.results.get_nowait()
+            if future.exception() is not None:
+                print("Request failed:", repr(future.exception()),
+                    file=sys.stderr)
         
         if self.settings_changed:
             # Create the new file with a similar name in the same directory
@@ -99,11 +148,34 @@ class main:
         if self.access.get():
             self.settings["access_token"] = self.access.get()
         self.auth_window.destroy()
+        saved = None
+        if self.replica is not None:
+            saved = self.replica.load(self.settings["spreadsheet"])
+        if saved is None:
+            self.submit(self.on_worksheet, self.get_worksheet)
+            return
+        [worksheets, columns, post, next_index, count, mark, rows] = saved
+        self.show_worksheet(worksheets, columns)
+        for [id, row, edit, values] in rows:
+            item = self.add_row(id, values, edit)
+            self.rows[item] = row
+            if row is not None:
+                self.last_row = max(self.last_row, row)
+        self.post = post
+        self.next_index = next_index
+        self.count = count
+        self.mark = mark
+        print(len(rows), "rows from replica", file=sys.stderr)
+        if mark is None:  # First page was never downloaded
+            self.load_page()
+        else:
+            self.submit(self.on_changes, self.get_changes, mark)
+    
+    def get_worksheet(self):
+        '''Downloads the worksheet entry and the column headings
         
-        view_frame = Frame(self.tk)
-        view_frame.pack(fill=tkinter.BOTH,
-            side=tkinter.BOTTOM, expand=True)
-        
+        Returns the worksheets feed, and a list of (heading, name) for
+        the columns.'''
         url = urljoin_path(
             "https://spreadsheets.google.com/feeds/worksheets/",
             self.settings["spreadsheet"],
@@ -111,30 +183,20 @@ class main:
             "basic",
         )
         worksheets = self.atom_request(url=url)
-        [self.worksheet] = worksheets.iter(ATOM_PREFIX + "entry")
-        [title] = worksheets.iterfind(ATOM_PREFIX + "title")
-        title = "".join(title.itertext())
-        self.tk.wm_title(title)
-        
-        [ws_title] = self.worksheet.iter(ATOM_PREFIX + "title")
-        ws_title = "".join(ws_title.itertext())
-        [updated] = self.worksheet.iter(ATOM_PREFIX + "updated")
-        updated = "".join(updated.itertext())
-        msg = "“{}”, “{}”, updated {}".format(title, ws_title, updated)
-        print(msg, file=sys.stderr)
+        [worksheet] = worksheets.iter(ATOM_PREFIX + "entry")
         
-        headings = list()
-        self.name_list = list()
+        columns = list()
         name_set = set()
         query = (("min-row", "1"), ("max-row", "1"))
-        feed = self.get_feed(CELLS_REL, "basic", query)
-        for entry in feed.iter(ATOM_PREFIX + "entry"):  # TODO: limit number of entries downloaded
+        entries = self.get_all_entries(CELLS_REL, "basic", query,
+            worksheet=worksheet)
+        for entry in entries:
             [address] = entry.iterfind(ATOM_PREFIX + "title[@type='text']")
             address = "".join(address.itertext())
             if not "A1" <= address <= "Z1":
                 raise ValueError(address)
             column = ord(address[0]) - ord("A")
-            if column != len(headings):
+            if column != len(columns):
                 raise ValueError(address)
             
             [heading] = entry.iterfind(ATOM_PREFIX + "content[@type='text']")
@@ -142,23 +204,66 @@ class main:
             name = heading.translate(AlnumOnlyMap()).lower()
             if name in name_set:
                 raise ValueError(heading)
-            headings.append(heading)
-            self.name_list.append(name)
+            columns.append((heading, name))
             name_set.add(name)
+        return (worksheets, columns)
+    
+    def on_worksheet(self, future):
+        [worksheets, columns] = future.result()
+        if self.replica is not None:
+            self.replica.reset(self.settings["spreadsheet"],
+                worksheets, columns)
+        self.show_worksheet(worksheets, columns)
+        self.load_page()
+    
+    def show_worksheet(self, worksheets, columns):
+        '''Sets up the view and the "Add record" window'''
+        self.columns = columns
+        [self.worksheet] = worksheets.iter(ATOM_PREFIX + "entry")
+        [title] = worksheets.iterfind(ATOM_PREFIX + "title")
+        title = "".join(title.itertext())
+        self.tk.wm_title(title)
         
-        self.view = Tree(view_frame, tree=False, columns=headings)
+        [ws_title] = self.worksheet.iter(ATOM_PREFIX + "title")
+        ws_title = "".join(ws_title.itertext())
+        [updated] = self.worksheet.iter(ATOM_PREFIX + "updated")
+        updated = "".join(updated.itertext())
+        msg = "“{}”, “{}”, updated {}".format(title, ws_title, updated)
+        print(msg, file=sys.stderr)
+        
+        headings = [heading for [heading, _] in columns]
+        self.name_list = [name for [_, name] in columns]
+        self.view_frame = Frame(self.tk)
+        self.view_frame.pack(fill=tkinter.BOTH,
+            side=tkinter.BOTTOM, expand=True)
+        self.view = Tree(self.view_frame, tree=False, columns=headings)
         scroll(self.view)
+        self.yscrollcommand = self.view.cget("yscrollcommand")
+        self.view.configure(yscrollcommand=self.on_yscroll)
         self.view.bind("<Double-1>", self.on_double_click)
         self.view.bind("<Button-3>", self.on_right_click)
+        self.view.tag_configure("queued",
+            foreground=valid_colour(self.view, "blue", "black"))
+        self.view.tag_configure("sending",
+            foreground=valid_colour(self.view, "grey", "black"))
         
         self.edit_links = dict()
-        query = (("orderby", "column:value"),)
-        feed = self.get_feed(LIST_REL, "full", query)
-        self.post = atom_link(feed, POST_REL)
-        for entry in feed.iter(ATOM_PREFIX + "entry"):  # TODO: limit number of entries downloaded
-            self.add_entry(entry)
+        self.values = dict()
+        self.entry_ids = dict()  # Id of the list feed entry for each item
+        self.items = dict()  # Item for each list feed entry id
+        self.rows = dict()  # Sheet row number, if known, for each item
+        self.last_row = 1
+        self.cell_links = dict()  # Edit link for each (item, column)
+        self.filters = dict()  # (mode, text) for each column number
+        self.indexes = dict()  # Items for each value, for each column number
+        self.post = None
+        self.next_index = 1  # Start of the next page; None after the end
+        self.loading = False
+        self.count = None  # Rows in the list feed
+        self.mark = None  # Updated time of the list feed when downloaded
         
-        window = tkinter.Toplevel(self.tk)
+        self.add_window = tkinter.Toplevel(self.tk)
+        window = self.add_window
         window.wm_title("Add record")
         form = Form(window)
         self.add_entries = list()
@@ -188,13 +293,341 @@ class main:
             return
         Filter(self, column)
     
+    def on_yscroll(self, first, last):
+        if self.yscrollcommand:
+            self.tk.call(*self.tk.splitlist(self.yscrollcommand),
+                first, last)
+        if self.next_index is None or self.loading:
+            return
+        if float(last) >= 1 - LOAD_MARGIN:
+            # Load during idle time rather than during the scrolling
+            self.loading = True
+            self.tk.after_idle(self.load_page)
+    
+    def load_page(self):
+        '''Starts downloading the next page of the list feed'''
+        self.loading = True
+        self.submit(partial(self.on_page, self.next_index),
+            self.get_page, self.next_index, self.generation)
+    
+    def get_page(self, start, generation):
+        '''Passes batches of entries to on_entries() while parsing
+        
+        Returns the feed without its entries, and the number of
+        entries.'''
+        entries = list()
+        count = 0
+        def send():
+            nonlocal entries, count
+            self.deliver(partial(self.on_entries, start + count), entries,
+                generation)
+            count += len(entries)
+            entries = list()
+        def entry(element):
+            entries.append(element)
+            if len(entries) >= ENTRY_BATCH:
+                send()
+        feed = self.get_feed(LIST_REL, "full", (), start, entry=entry)
+        if entries:
+            send()
+        return (feed, count)
+    
+    def on_entries(self, start, future):
+        '''Adds rows while a page is being downloaded
+        
+        The rows are saved before on_page() saves "next_index", so after
+        an interruption, the replica may already have some of the page.
+        add_row() matches these by entry id when the page is downloaded
+        again.'''
+        items = list()
+        for [i, entry] in enumerate(future.result()):
+            item = self.add_entry(entry)
+            # Entries are in sheet order, after the heading row
+            self.rows[item] = start + i + 1
+            items.append(item)
+        self.save_rows(items)
+        if self.filters:
+            self.apply_filters()
+    
+    def on_page(self, start, future):
+        '''Finishes adding the rows of a downloaded page'''
+        self.loading = False
+        [feed, count] = future.result()
+        if self.post is None:
+            self.post = atom_link(feed, POST_REL)
+        if self.mark is None:
+            self.count = total_results(feed)
+            self.mark = feed_updated(feed)
+        self.last_row = max(self.last_row, start + count)
+        if count < self.page_size:
+            self.next_index = None
+        else:
+            self.next_index = start + count
+        self.save_rows((), post=self.post, next_index=self.next_index,
+            count=self.count, updated=self.mark)
+    
+    def get_changes(self, mark):
+        '''Downloads what is needed to bring the replica up to date
+        
+        Returns the worksheets feed and columns as for get_worksheet(),
+        the list feed with only one entry, and the list entries updated
+        since "mark".'''
+        [worksheets, columns] = self.get_worksheet()
+        feed = self.get_feed(LIST_REL, "full", (("max-results", "1"),))
+        query = (("updated-min", mark),)
+        entries = list(self.get_all_entries(LIST_REL, "full", query))
+        return (worksheets, columns, feed, entries)
+    
+    def on_changes(self, future):
+        '''Updates the rows loaded from the replica'''
+        [worksheets, columns, feed, entries] = future.result()
+        if columns != self.columns or total_results(feed) != self.count:
+            print("Rows or columns added or removed; reloading",
+                file=sys.stderr)
+            self.reload(worksheets, columns)
+            return
+        # With the same count, a removed row means another was inserted,
+        # and an inserted row is listed as changed with a new id. An
+        # unknown id could also be a row not downloaded yet.
+        if not all(entry_id(entry) in self.items for entry in entries):
+            print("Rows inserted or not yet downloaded; reloading",
+                file=sys.stderr)
+            self.reload(worksheets, columns)
+            return
+        changed = list()
+        for entry in entries:
+            item = self.items[entry_id(entry)]
+            [values, edit] = parse_row(entry)
+            self.set_row(item, values, edit)
+            changed.append(item)
+        self.mark = feed_updated(feed)
+        self.save_rows(changed, updated=self.mark)
+        print(len(changed), "rows changed", file=sys.stderr)
+    
+    def reload(self, worksheets, columns):
+        '''Replaces the view and the replica with a fresh download'''
+        if self.edits:
+            print("Discarding", len(self.edits), "queued edits",
+                file=sys.stderr)
+            self.edits.clear()
+        self.sending.clear()
+        self.generation += 1
+        self.in_flight.clear()
+        self.view_frame.destroy()
+        self.add_window.destroy()
+        self.replica.reset(self.settings["spreadsheet"], worksheets, columns)
+        self.show_worksheet(worksheets, columns)
+        self.load_page()
+    
     def update_cell(self, event):
-        request = self.send_atom("PUT", self.edit_links[self.item])
+        '''Queues the edited cell to be sent with the next batch'''
+        if self.rows.get(self.item) is None:
+            self.put_cell(self.item, self.column, self.entry_var.get())
+            return
+        self.edits[(self.item, self.column)] = self.entry_var.get()
+        self.show_state(self.item)
+        self.schedule_flush()
+    
+    def schedule_flush(self):
+        if len(self.edits) >= BATCH_SIZE:
+            self.flush_edits()
+        elif self.edits and self.flush_timer is None:
+            self.flush_timer = self.tk.after(FLUSH_DELAY, self.flush_edits)
+    
+    def on_close(self):
+        self.flush_edits()
+        self.tk.destroy()
+    
+    def flush_edits(self, event=None):
+        '''Starts sending the queued cells in one batch request
+        
+        The current value of each cell is first looked up, unless the
+        cell's edit link is known from an earlier batch. A cell is not
+        updated if its value differs from the one shown, or if its
+        version has changed; these conflicts are reported per cell.
+        Cells still being sent by an earlier batch stay queued until it
+        finishes.'''
+        if self.flush_timer is not None:
+            self.tk.after_cancel(self.flush_timer)
+            self.flush_timer = None
+        if not self.edits:
+            return
+        feed = atom_link(self.worksheet, CELLS_REL)
+        edits = list()
+        for [key, text] in list(self.edits.items()):
+            if key in self.sending:
+                continue
+            [item, column] = key
+            row = self.rows[item]
+            cell = "R{}C{}".format(row, column + 1)
+            cell = urljoin_path(feed, "full", cell)
+            values = self.values[item]
+            shown = values[column] if column < len(values) else ""
+            edit = self.cell_links.get(key)
+            edits.append((key, text, cell, row, shown, edit))
+            del self.edits[key]
+            self.sending[key] = text
+        if not edits:
+            return
+        keys = [key for [key, *_] in edits]
+        self.start_requests(set(item for [item, _] in keys))
+        self.submit(partial(self.on_edits_sent, keys),
+            self.send_edits, feed, edits)
+    
+    def send_edits(self, feed, edits):
+        '''Looks up and updates cells for flush_edits()
+        
+        Returns (key, entry, status code, reason) for each edit, and the
+        list feed entries of the updated rows, which have new edit
+        links.'''
+        results = list()
+        links = dict()
+        lookups = list()
+        for [i, [_, _, cell, _, _, edit]] in enumerate(edits):
+            if edit is None:
+                lookups.append((i, "query", cell, None, None))
+            else:
+                links[i] = edit
+        for [i, entry, code, reason] in self.send_batch(feed, lookups):
+            [key, _, _, _, shown, _] = edits[i]
+            if code == http.client.OK and cell_text(entry) != shown:
+                code = http.client.CONFLICT
+                reason = "Sheet has {!r}, not {!r}".format(
+                    cell_text(entry), shown)
+            if code != http.client.OK:
+                results.append((key, None, code, reason))
+                continue
+            links[i] = atom_link(entry, "edit")
+        
+        updates = list()
+        for i in sorted(links):
+            [[_, column], text, cell, row, _, _] = edits[i]
+            attrs = {
+                "row": format(row),
+                "col": format(column + 1),
+                "inputValue": text,
+            }
+            updates.append((i, "update", cell, links[i], attrs))
+        rows = set()
+        for [i, entry, code, reason] in self.send_batch(feed, updates):
+            results.append((edits[i][0], entry, code, reason))
+            if code == http.client.OK:
+                rows.add(edits[i][3])
+        
+        # Download the updated rows in runs of consecutive rows
+        entries = list()
+        rows = sorted(rows)
+        while rows:
+            end = 1
+            while end < len(rows) and rows[end] == rows[0] + end:
+                end += 1
+            query = (
+                ("start-index", format(rows[0] - 1)),
+                ("max-results", format(end)),
+            )
+            self.get_feed(LIST_REL, "full", query, entry=entries.append)
+            del rows[:end]
+        return (results, entries)
+    
+    def on_edits_sent(self, keys, future):
+        items = set(item for [item, _] in keys)
+        for key in keys:
+            del self.sending[key]
+        self.end_requests(items)
+        try:
+            [results, entries] = future.result()
+        except:
+            self.schedule_flush()  # Edits held back for this batch
+            raise
+        for [key, entry, code, reason] in results:
+            if code != http.client.OK:
+                # Look the cell up again next time
+                self.cell_links.pop(key, None)
+                self.report_conflict(key, code, reason)
+                continue
+            self.cell_links[key] = atom_link(entry, "edit")
+            [item, column] = key
+            values = self.values[item]
+            values.extend([""] * (column + 1 - len(values)))
+            values[column] = cell_text(entry)
+            self.view.item(item, values=values)
+        ids = {self.entry_ids[item]: item for item in items}
+        for entry in entries:
+            item = ids.get(entry_id(entry))
+            if item is not None:  # Skip rows that have moved
+                self.edit_links[item] = atom_link(entry, "edit")
+        self.indexes.clear()
+        self.save_rows(items)
+        self.schedule_flush()  # Edits held back for this batch
+    
+    def send_batch(self, feed, operations):
+        '''Sends operations to the batch URL of the cells feed
+        
+        Each operation is (index, type, cell URL, edit link, gs:cell
+        attributes). Yields (index, entry, status code, reason) for each
+        operation. Operations missing from the response, for instance
+        because the batch was interrupted, are yielded with no entry or
+        code.'''
+        if not operations:
+            return
+        url = urljoin_path(feed, "full", "batch")
+        with closing(self.send_atom("POST", url, "feed")) as request:
+            xml = next(request)  # Start generating request body
+            no_attrs = xmlreader.AttributesImpl(dict())
+            xml.startElement("id", no_attrs)
+            xml.characters(urljoin_path(feed, "full"))
+            xml.endElement("id")
+            for [i, type, cell, edit, attrs] in operations:
+                xml.startElement("entry", no_attrs)
+                xml.startElement("batch:id", no_attrs)
+                xml.characters(format(i))
+                xml.endElement("batch:id")
+                type = xmlreader.AttributesImpl(dict(type=type))
+                xml.startElement("batch:operation", type)
+                xml.endElement("batch:operation")
+                xml.startElement("id", no_attrs)
+                xml.characters(cell)
+                xml.endElement("id")
+                if edit is not None:
+                    xml.startElement("link", xmlreader.AttributesImpl(dict(
+                        rel="edit", type="application/atom+xml", href=edit)))
+                    xml.endElement("link")
+                if attrs is not None:
+                    attrs = xmlreader.AttributesImpl(attrs)
+                    xml.startElement("gs:cell", attrs)
+                    xml.endElement("gs:cell")
+                xml.endElement("entry")
+                xml.ignorableWhitespace("\n")
+            [response] = request  # Send request and receive response
+        missing = set(i for [i, _, _, _, _] in operations)
+        for entry in response.iterfind(ATOM_PREFIX + "entry"):
+            [i] = entry.iterfind("{" + BATCH_NS + "}id")
+            i = int(i.text)
+            [status] = entry.iterfind("{" + BATCH_NS + "}status")
+            missing.remove(i)
+            yield (i, entry, int(status.get("code")), status.get("reason"))
+        for i in sorted(missing):
+            yield (i, None, None, "Not processed")
+    
+    def report_conflict(self, key, code, reason):
+        [item, column] = key
+        msg = "Row {}, {}: {} {}".format(self.rows[item],
+            self.name_list[column], code, reason)
+        print(msg, file=sys.stderr)
+    
+    def put_cell(self, item, column, text):
+        '''Starts updating one cell through its list feed entry'''
+        self.start_requests((item,))
+        self.submit(partial(self.on_cell_put, item), self.send_cell,
+            self.edit_links[item], self.name_list[column], text)
+    
+    def send_cell(self, edit, name, text):
+        request = self.send_atom("PUT", edit)
         with closing(request):
             xml = next(request)  # Start generating request body
-            name = "gsx:" + self.name_list[self.column]
+            name = "gsx:" + name
             xml.startElement(name, xmlreader.AttributesImpl(dict()))
-            xml.characters(self.entry_var.get())
+            xml.characters(text)
             xml.endElement(name)
             try:
                 [entry] = request  # Send request and receive response
@@ -208,35 +641,111 @@ class main:
                 parser = ElementTree.XMLParser(encoding=charset)
                 dump_tree(ElementTree.parse(err, parser).getroot())
                 raise
+        return entry
+    
+    def on_cell_put(self, item, future):
+        try:
+            entry = future.result()
+        finally:
+            self.end_requests((item,))
         [values, edit] = parse_row(entry)
-        self.view.item(self.item, values=values)
-        self.edit_links[self.item] = edit
+        self.set_row(item, values, edit)
+        self.save_rows((item,))
     
     def on_add_enter(self, event):
-        with closing(self.send_atom("POST", self.post)) as request:
+        if self.count is None:
+            # The post link and row count come with the first page
+            print("Cannot add until the first page is loaded",
+                file=sys.stderr)
+            return
+        values = [entry.get() for entry in self.add_entries]
+        self.submit(self.on_added, self.send_row, self.post, values)
+    
+    def send_row(self, post, values):
+        with closing(self.send_atom("POST", post)) as request:
             xml = next(request)  # Start generating request body
-            for [name, entry] in zip(self.name_list, self.add_entries):
+            for [name, value] in zip(self.name_list, values):
                 name = "gsx:" + name
                 xml.startElement(name, xmlreader.AttributesImpl(dict()))
-                xml.characters(entry.get())
+                xml.characters(value)
                 xml.endElement(name)
                 xml.ignorableWhitespace("\n")
             [entry] = request  # Send request and receive response
-        item = self.add_entry(entry)
+        return entry
+    
+    def on_added(self, future):
+        item = self.add_entry(future.result())
+        if self.next_index is None:
+            # Appended after the last row
+            self.last_row += 1
+            self.rows[item] = self.last_row
+        self.count += 1
+        self.save_rows((item,), count=self.count)
         self.view.selection_set((item,))
         self.view.see(item)
     
-    def send_atom(self, method, url):
+    def submit(self, callback, func, *args):
+        '''Calls "func" on a worker thread
+        
+        When it is done, "callback" is called on the Tk thread with the
+        future.'''
+        future = self.pool.submit(func, *args)
+        generation = self.generation
+        def done(future):
+            self.results.put((callback, future, generation))
+        future.add_done_callback(done)
+    
+    def deliver(self, callback, result, generation):
+        '''Passes a result from a worker thread to "callback"
+        
+        The callback is called on the Tk thread with a completed
+        future, unless a reload has started a new generation.'''
+        future = Future()
+        future.set_result(result)
+        self.results.put((callback, future, generation))
+    
+    def poll_results(self):
+        self.tk.after(POLL_INTERVAL, self.poll_results)
+        while True:
+            try:
+                [callback, future, generation] = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if generation == self.generation:
+                callback(future)
+    
+    def start_requests(self, items):
+        for item in items:
+            self.in_flight[item] += 1
+            self.show_state(item)
+    
+    def end_requests(self, items):
+        for item in items:
+            self.in_flight[item] -= 1
+            self.show_state(item)
+    
+    def show_state(self, item):
+        if self.in_flight[item]:
+            tags = ("sending",)
+        elif any(edit_item == item for [edit_item, _] in self.edits):
+            tags = ("queued",)
+        else:
+            tags = ()
+        self.view.item(item, tags=tags)
+    
+    def send_atom(self, method, url, root="entry"):
         stream = TextIOWrapper(BytesIO(), "utf-8", "xmlcharrefreplace",
             newline="\r\n")
         xml = XMLGenerator(stream, "UTF-8", short_empty_elements=True)
         xml.startDocument()
-        xml.startElement("entry", xmlreader.AttributesImpl({
+        xml.startElement(root, xmlreader.AttributesImpl({
             "xmlns": ATOM_NS,
+            "xmlns:gs": GOOGLE_SHEET_NS,
             "xmlns:gsx": GOOGLE_SHEETX_NS,
+            "xmlns:batch": BATCH_NS,
         }))
         yield xml
-        xml.endElement("entry")
+        xml.endElement(root)
         xml.ignorableWhitespace("\n")
         xml.endDocument()
         
@@ -246,27 +755,130 @@ class main:
             ),
             data=stream.detach().getvalue(),
         )
-        yield tree
+        yield tree.getroot()
     
-    def get_feed(self, rel, projection=None, query=()):
-        url = atom_link(self.worksheet, rel)
+    def get_feed(self, rel, projection=None, query=(), start=None, *,
+            entry=None, worksheet=None):
+        '''Requests a feed, or one page of it if "start" is given
+        
+        The "start" index counts from 1. See atom_request() for "entry".
+        The feed is linked from "worksheet", or else from the current
+        worksheet entry.'''
+        if worksheet is None:
+            worksheet = self.worksheet
+        url = atom_link(worksheet, rel)
         if projection is not None:
             url = urljoin_path(url, projection)
+        if start is not None:
+            query = tuple(query) + (
+                ("start-index", format(start)),
+                ("max-results", format(self.page_size)),
+            )
         url = urllib.parse.urljoin(url, "?" + urllib.parse.urlencode(query))
-        return self.atom_request(url=url)
+        return self.atom_request(url=url, entry=entry)
+    
+    def get_all_entries(self, rel, projection=None, query=(), *,
+            worksheet=None):
+        '''Yields the entries of a feed, requesting it page by page'''
+        start = 1
+        while True:
+            entries = list()
+            self.get_feed(rel, projection, query, start,
+                entry=entries.append, worksheet=worksheet)
+            yield from entries
+            if len(entries) < self.page_size:
+                break
+            start += len(entries)
     
     def add_entry(self, entry):
         [values, edit] = parse_row(entry)
+        return self.add_row(entry_id(entry), values, edit)
+    
+    def add_row(self, id, values, edit):
+        '''Returns the item for a list feed entry
+        
+        An entry that already has an item, for instance because it was
+        added before the last page was downloaded, updates that item.'''
+        item = self.items.get(id)
+        if item is not None:
+            self.set_row(item, values, edit)
+            return item
         item = self.view.add(values=values)
+        self.entry_ids[item] = id
+        self.items[id] = item
         self.edit_links[item] = edit
+        self.values[item] = values
+        self.indexes.clear()
         return item
     
-    def atom_request(self, *, method="GET", url, headers=(), **args):
+    def set_row(self, item, values, edit):
+        self.view.item(item, values=values)
+        self.edit_links[item] = edit
+        self.values[item] = values
+        self.indexes.clear()
+        # The versions of the cells have changed
+        for column in range(len(self.name_list)):
+            self.cell_links.pop((item, column), None)
+    
+    def save_rows(self, items, **fields):
+        '''Updates the replica, if any'''
+        if self.replica is None:
+            return
+        rows = ((self.entry_ids[item], self.rows.get(item),
+            self.edit_links[item], self.values[item]) for item in items)
+        self.replica.save(self.settings["spreadsheet"], rows, **fields)
+    
+    def filter(self, column, mode, text):
+        '''Raises ValueError or re.error for an invalid filter'''
+        narrow = text and column not in self.filters
+        if text:
+            filter_test(mode, text)  # Check before storing the filter
+            self.filters[column] = (mode, text)
+        else:
+            self.filters.pop(column, None)
+        if narrow:
+            # Only need to check the items already shown
+            matches = set(filter_index(self.index(column), mode, text))
+            attached = (item for item in self.view.get_children()
+                if item in matches)
+            self.view.set_children("", *attached)
+        else:
+            self.apply_filters()
+    
+    def apply_filters(self):
+        '''Shows only the items matching all the filters'''
+        attached = sorted(self.edit_links.keys())
+        for [column, [mode, text]] in self.filters.items():
+            matches = set(filter_index(self.index(column), mode, text))
+            attached = [item for item in attached if item in matches]
+        self.view.set_children("", *attached)
+    
+    def index(self, column):
+        index = self.indexes.get(column)
+        if index is None:
+            index = dict()
+            for [item, values] in self.values.items():
+                if column < len(values):
+                    value = values[column]
+                else:
+                    value = ""
+                index.setdefault(value, list()).append(item)
+            self.indexes[column] = index
+        return index
+    
+    def atom_request(self, *, method="GET", url, headers=(), entry=None,
+            **args):
+        '''Returns the response as an ElementTree
+        
+        If "entry" is given, it is called with each entry of a feed as
+        soon as it has been parsed, and the entries are left out of the
+        returned tree.'''
         all_headers = {"Accept": ", ".join(ATOM_TYPES)}
         all_headers.update(headers)
         request = urllib.request.Request(method=method, url=url,
             headers=all_headers, **args)
-        if "access_token" in self.settings:
+        token = self.settings.get("access_token")
+        if token is not None:
             try:
                 [response, headers] = self.try_request(request)
             except HTTPError as response:
@@ -295,45 +907,10 @@ class main:
         else:
             refresh = True
         if refresh:
-            # The accounts.google.com server tends to shut the TCP connection
-            # down before indicating EOF at the SSL level. As long as the
-            # response is JSON, this should not matter.
-            context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-            try:  # Python with more secure SSLEOFError handling
-                context.suppress_ragged_eofs = True
-            except AttributeError:  # EOF error already handled as secure EOF
-                pass
-            handler = urllib.request.HTTPSHandler(context=context)
-            urlopen = urllib.request.build_opener(handler).open
-            type = ("Content-Type",
-                "application/x-www-form-urlencoded; charset=UTF-8")
-            print("POST grant_type=refresh_token",
-                end=" ", flush=True, file=sys.stderr)
-            response = http_request(
-                urlopen=urlopen,
-                method="POST",
-                # URL taken from "console" JSON data; documented URL failed
-                url="https://accounts.google.com/o/oauth2/token",
-                headers=(type,),
-                data=urllib.parse.urlencode((
-                    ("grant_type", "refresh_token"),
-                    ("refresh_token", self.settings["refresh_token"]),
-                    ("client_id", self.settings["client_id"]),
-                    ("client_secret", self.settings["client_secret"]),
-                ), encoding="utf-8").encode("ascii"),
-                types=("application/json",),
-            )
-            with TextIOWrapper(response, "utf-8") as text:
-                print(response.status, response.reason,
-                    end=" ", flush=True, file=sys.stderr)
-                # TODO: limit data
-                response = json.load(text)
-            msg = "token_type: {token_type}, expires_in: {expires_in}"
-            print(msg.format_map(response), file=sys.stderr)
-            if response["token_type"] != "Bearer":
-                raise ValueError(response)
-            self.settings["access_token"] = response["access_token"]
-            self.settings_changed = True
+            with self.lock:
+                # Another thread may have refreshed the token already
+                if self.settings.get("access_token") == token:
+                    self.refresh_access()
             [response, headers] = self.try_request(request)
         with response:
             print(response.status, response.reason,
@@ -343,30 +920,180 @@ class main:
                 raise TypeError("Unexpected content type " + repr(type))
             charset = headers.get_content_charset()
             parser = ElementTree.XMLParser(encoding=charset)
-            tree = ElementTree.parse(response, parser)
+            if entry is None:
+                tree = ElementTree.parse(response, parser)
+            else:
+                tree = parse_entries(response, parser, entry)
+                tree = ElementTree.ElementTree(tree)
         print(file=sys.stderr)
         return tree
     
+    def refresh_access(self):
+        # The accounts.google.com server tends to shut the TCP connection
+        # down before indicating EOF at the SSL level. As long as the
+        # response is JSON, this should not matter.
+        context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+        try:  # Python with more secure SSLEOFError handling
+            context.suppress_ragged_eofs = True
+        except AttributeError:  # EOF error already handled as secure EOF
+            pass
+        handler = urllib.request.HTTPSHandler(context=context)
+        urlopen = urllib.request.build_opener(handler).open
+        type = ("Content-Type",
+            "application/x-www-form-urlencoded; charset=UTF-8")
+        print("POST grant_type=refresh_token",
+            end=" ", flush=True, file=sys.stderr)
+        response = http_request(
+            urlopen=urlopen,
+            method="POST",
+            # URL taken from "console" JSON data; documented URL failed
+            url="https://accounts.google.com/o/oauth2/token",
+            headers=(type,),
+            data=urllib.parse.urlencode((
+                ("grant_type", "refresh_token"),
+                ("refresh_token", self.settings["refresh_token"]),
+                ("client_id", self.settings["client_id"]),
+                ("client_secret", self.settings["client_secret"]),
+            ), encoding="utf-8").encode("ascii"),
+            types=("application/json",),
+        )
+        with TextIOWrapper(response, "utf-8") as text:
+            print(response.status, response.reason,
+                end=" ", flush=True, file=sys.stderr)
+            # TODO: limit data
+            response = json.load(text)
+        msg = "token_type: {token_type}, expires_in: {expires_in}"
+        print(msg.format_map(response), file=sys.stderr)
+        if response["token_type"] != "Bearer":
+            raise ValueError(response)
+        self.settings["access_token"] = response["access_token"]
+        self.settings_changed = True
+    
     def try_request(self, request):
         auth = "Bearer " + self.settings["access_token"]
         request.add_header("Authorization", auth)
         print(request.get_method(), request.full_url,
             end=" ", flush=True, file=sys.stderr)
-        response = self.session.open(request)
+        try:
+            session = self.local.session
+        except AttributeError:
+            # Each worker thread has its own persistent connection
+            connection = PersistentConnectionHandler(timeout=100)
+            with self.lock:
+                self.connections.enter_context(connection)
+            session = urllib.request.build_opener(connection)
+            self.local.session = session
+        response = session.open(request)
         headers = response.info()
         headers.set_default_type(None)
         return (response, headers)
 
+LOAD_MARGIN = 0.1  # Fraction of the view scrolled from the end
+FLUSH_DELAY = 2000  # Milliseconds to collect edits before sending them
+BATCH_SIZE = 100  # Queued edits that trigger sending straight away
+WORKERS = 4  # Requests that can be in flight at once
+POLL_INTERVAL = 50  # Milliseconds between checks for finished requests
+ENTRY_BATCH = 50  # Rows passed to the Tk thread at a time while loading
+
+class Replica:
+    '''Keeps a copy of worksheets in an SQLite database
+    
+    Each worksheet is keyed by its spreadsheet's key, and its rows by
+    the ids of their list feed entries.'''
+    
+    FIELDS = {"post", "next_index", "count", "updated"}
+    
+    def __init__(self, path):
+        import sqlite3
+        self._db = sqlite3.connect(path)
+        with self._db:
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS worksheets (
+                    spreadsheet TEXT PRIMARY KEY, feed BLOB NOT NULL,
+                    columns TEXT NOT NULL, post TEXT, next_index INTEGER,
+                    count INTEGER, updated TEXT)''')
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS rows (
+                    spreadsheet TEXT, id TEXT, row INTEGER,
+                    edit TEXT NOT NULL, data TEXT NOT NULL,
+                    PRIMARY KEY (spreadsheet, id))''')
+    
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self._db.close()
+    
+    def load(self, spreadsheet):
+        '''Returns None if the worksheet is not known
+        
+        Otherwise returns (worksheets feed, columns, post link,
+        next_index, count, updated, rows), where each row is (entry id,
+        sheet row, edit link, values).'''
+        worksheet = self._db.execute('''
+            SELECT feed, columns, post, next_index, count, updated
+            FROM worksheets WHERE spreadsheet = ?''',
+            (spreadsheet,)).fetchone()
+        if worksheet is None:
+            return None
+        [feed, columns, *fields] = worksheet
+        feed = ElementTree.ElementTree(ElementTree.fromstring(feed))
+        columns = list(map(tuple, json.loads(columns)))
+        rows = self._db.execute('''
+            SELECT id, row, edit, data FROM rows WHERE spreadsheet = ?
+            ORDER BY row IS NULL, row, rowid''', (spreadsheet,))
+        rows = [(id, row, edit, json.loads(data))
+            for [id, row, edit, data] in rows]
+        return (feed, columns, *fields, rows)
+    
+    def reset(self, spreadsheet, feed, columns):
+        '''Replaces a worksheet with one that has no rows'''
+        feed = ElementTree.tostring(feed.getroot())
+        with self._db:
+            self._db.execute("DELETE FROM rows WHERE spreadsheet = ?",
+                (spreadsheet,))
+            self._db.execute('''
+                INSERT OR REPLACE INTO worksheets
+                VALUES (?, ?, ?, NULL, 1, NULL, NULL)''',
+                (spreadsheet, feed, json.dumps(columns)))
+    
+    def save(self, spreadsheet, rows, **fields):
+        '''Adds or replaces rows, and sets worksheet fields'''
+        if not fields.keys() <= self.FIELDS:
+            raise TypeError("Unknown fields: {}".format(
+                ", ".join(fields.keys() - self.FIELDS)))
+        rows = ((spreadsheet, id, row, edit, json.dumps(values))
+            for [id, row, edit, values] in rows)
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO rows VALUES (?, ?, ?, ?, ?)", rows)
+            if fields:
+                sql = "UPDATE worksheets SET {} WHERE spreadsheet = ?"
+                sql = sql.format(", ".join(name + " = ?" for name in fields))
+                self._db.execute(sql, (*fields.values(), spreadsheet))
+
 class Filter:
+    '''Window to set or clear the filter for a column
+    
+    The "ui" object should have a "filters" dictionary and a "filter"
+    method, which raises ValueError or re.error for an invalid filter.
+    Filters on different columns are combined.'''
+    
     def __init__(self, ui, column):
         self.ui = ui
-        self.column = column
+        self.column = int(column.lstrip("#")) - 1
         self.window = tkinter.Toplevel(self.ui.tk)
         self.window.bind("<Return>", self.on_enter)
         self.window.bind("<KP_Enter>", self.on_enter)
         self.window.bind("<Escape>", self.on_escape)
         self.window.wm_title("Filter")
+        [mode, text] = self.ui.filters.get(self.column, ("equals", ""))
+        self.mode = Combobox(self.window,
+            values=FILTER_MODES, state="readonly")
+        self.mode.set(mode)
+        self.mode.pack(fill=tkinter.BOTH)
         self.entry = Entry(self.window)
+        self.entry.insert(0, text)
+        self.entry.selection_range(0, tkinter.END)
         self.entry.pack(fill=tkinter.BOTH)
         self.entry.focus_set()
     
@@ -374,22 +1101,102 @@ class Filter:
         self.window.destroy()
     
     def on_enter(self, event):
-        filter = self.entry.get()
-        attached = list()
-        for item in sorted(self.ui.edit_links.keys()):
-            if self.ui.view.set(item, self.column) == filter:
-                attached.append(item)
-        self.ui.view.set_children("", *attached)
+        try:
+            self.ui.filter(self.column, self.mode.get(), self.entry.get())
+        except (ValueError, re.error) as err:
+            # Leave the window open to correct the filter
+            showerror("Filter", "Invalid filter: {}".format(err),
+                parent=self.window)
+            return
         self.window.destroy()
 
+FILTER_MODES = ("equals", "prefix", "contains", "range", "regex")
+
+def filter_index(index, mode, text):
+    '''Yields the rows matching a filter from an index
+    
+    The index maps each distinct value to a sequence of rows, so that the
+    filter is only tested once per value.'''
+    if mode == "equals":
+        yield from index.get(text, ())
+        return
+    test = filter_test(mode, text)
+    for [value, rows] in index.items():
+        if test(value):
+            yield from rows
+
+def filter_test(mode, text):
+    '''Returns a function that tests a value against a filter
+    
+    For "range", the text is "low..high", and either limit may be empty.
+    Values are compared as numbers, ignoring a leading dollar sign.'''
+    if mode == "equals":
+        return text.__eq__
+    if mode == "prefix":
+        return lambda value: value.startswith(text)
+    if mode == "contains":
+        return lambda value: text in value
+    if mode == "regex":
+        return re.compile(text).search
+    if mode == "range":
+        [low, _, high] = text.partition("..")
+        low = float(low.lstrip("$")) if low.strip() else -math.inf
+        high = float(high.lstrip("$")) if high.strip() else +math.inf
+        def test(value):
+            try:
+                value = float(value[value.startswith("$"):])
+            except ValueError:
+                return False
+            return low <= value <= high
+        return test
+    raise ValueError("Unknown filter mode: " + repr(mode))
+
+def parse_entries(source, parser, callback):
+    '''Parses a feed, passing each entry to "callback" once complete
+    
+    Each entry is removed from the feed after the callback returns, so
+    that memory does not grow with the number of entries. Returns the
+    root element of the feed.'''
+    root = None
+    depth = 0
+    events = ElementTree.iterparse(source, ("start", "end"), parser)
+    for [event, element] in events:
+        if event == "start":
+            if root is None:
+                root = element
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1 and element.tag == ATOM_PREFIX + "entry":
+            callback(element)
+            root.remove(element)
+    return root
+
 def parse_row(entry):
     values = list()
-    for child in entry.iter():
+    for child in entry:
         if not child.tag.startswith("{" + GOOGLE_SHEETX_NS + "}"):
             continue
         values.append("".join(child.itertext()))
     return (values, atom_link(entry, "edit"))
 
+def cell_text(entry):
+    '''Returns the displayed value of a cells feed entry'''
+    [cell] = entry.iterfind("{" + GOOGLE_SHEET_NS + "}cell")
+    return cell.text or ""
+
+def entry_id(entry):
+    [id] = entry.iterfind(ATOM_PREFIX + "id")
+    return id.text
+
+def feed_updated(feed):
+    [updated] = feed.iterfind(ATOM_PREFIX + "updated")
+    return updated.text
+
+def total_results(feed):
+    [total] = feed.iterfind("{" + OPEN_SEARCH_NS + "}totalResults")
+    return int(total.text)
+
 def atom_link(root, rel):
     xpath = "{}link[@rel='{}'][@type][@href]".format(ATOM_PREFIX, rel)
     links = root.iterfind(xpath)
@@ -2,76 +2,818 @@
 
 import csv
 from sys import stderr, stdout
-from io import TextIOWrapper, BufferedIOBase
+from io import TextIOWrapper, BufferedIOBase, BytesIO
+from io import IncrementalNewlineDecoder
+import codecs
+import locale
 from net import PersistentConnectionHandler, http_request, header_list
 import urllib.request
+import urllib.parse
 from xml.etree.ElementTree import TreeBuilder
 from contextlib import ExitStack
 from html.parser import HTMLParser
-from streams import DelegateWriter
-from shutil import copyfileobj
 import os, os.path
 import hashlib
+import zlib
 from base64 import urlsafe_b64encode
 from email.message import Message
 import email.generator
+import email.utils
+from urllib.error import HTTPError
+import http.client
+import time
+from tempfile import NamedTemporaryFile
 from data import rewrap
 from gzip import GzipFile
+from functions import attributes
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from itertools import islice
+import re
+from types import SimpleNamespace
+import json
+import copy
 
-def main(url):
-    with PersistentConnectionHandler(timeout=100) as handler, \
-            rewrap(stdout, newline="") as out:
-        urlopen = urllib.request.build_opener(handler).open
-        out = csv.writer(out)
+@attributes(param_types=dict(connections=int, max_age=float))
+def main(url, *, connections=1, tree=False, cache=None, max_age=None,
+        output=None, results=None, metrics=None):
+    '''Scrapes a paginated list of products to CSV
+    
+    With more than one connection, pages are fetched and decompressed on
+    separate threads, and when the page URLs follow a simple numbering
+    scheme, later pages are fetched ahead of time. Normally each row is
+    written as soon as it has been parsed; with --tree, each page is
+    parsed into a complete tree first.
+    
+    Pages are cached in files under the current directory, or in the
+    SQLite database given by --cache. See import_cache() to convert the
+    former to the latter. Cached pages are revalidated once stale
+    according to their header fields, or once older than --max-age
+    seconds if given.
+    
+    The CSV is written to stdout, or to the --output file. With an
+    output file, progress is saved after each page in a checkpoint file
+    next to it. If the crawl is interrupted, running it again resumes
+    after the last completed page, appending to the output.
+    
+    If --results gives an SQLite database, the rows scraped from each
+    page are saved in it, keyed by a hash of the page. Pages seen
+    before are then output from there without being parsed again.
+    
+    A summary of the time and data taken by each stage is printed at
+    the end. If --metrics names a file, the measurements for each page
+    are also appended to it as JSON lines.'''
+    with ExitStack() as cleanup:
+        fetcher = Fetcher(connections, cache, max_age,
+            digest=results is not None)
+        cleanup.enter_context(fetcher)
+        if results is not None:
+            results = cleanup.enter_context(ResultCache(results))
+        if output is None:
+            out = cleanup.enter_context(rewrap(stdout, newline=""))
+            out = CsvOutput(out)
+        else:
+            out = None
+        log = cleanup.enter_context(MetricsLog(metrics))
+        scrape_list(url, fetcher, out=out, output=output,
+            results=results, tree=tree, log=log)
+        fetcher.policy.report()
+        log.report()
+
+@attributes(param_types=dict(
+    connections=int, per_host=int, rate=float, max_age=float))
+def schedule(*urls, connections=4, per_host=2, rate=None,
+        dir=os.curdir, combined=False,
+        tree=False, cache=None, max_age=None, results=None, metrics=None):
+    '''Scrapes several paginated lists at once
+    
+    Each URL is the first page of a list, such as a product category.
+    Up to --connections lists are scraped at a time, sharing the
+    connections, page cache and result cache. No more than --per-host
+    requests are in progress to each host, and if --rate is given, no
+    more than that many requests per second are started to each host.
+    Pages served from the cache are not limited.
+    
+    Normally each list is written to its own CSV file in --dir, named
+    after the last segment of its URL, with a checkpoint file as for
+    main(). With --combined, all lists are written to stdout instead,
+    with an extra "category" column holding the list's URL.
+    
+    The other options are the same as for main().'''
+    with ExitStack() as cleanup:
+        limits = HostLimits(per_host, rate)
+        fetcher = Fetcher(connections, cache, max_age,
+            digest=results is not None, limits=limits)
+        cleanup.enter_context(fetcher)
+        if results is not None:
+            results = cleanup.enter_context(ResultCache(results))
+        if combined:
+            combined = cleanup.enter_context(rewrap(stdout, newline=""))
+            combined = CombinedOutput(combined)
+        log = cleanup.enter_context(MetricsLog(metrics))
+        
+        names = set()
+        with ThreadPoolExecutor(connections) as lists:
+            futures = list()
+            for url in urls:
+                if combined:
+                    params = dict(out=combined.category(url))
+                else:
+                    name = list_file_name(url, names)
+                    params = dict(output=os.path.join(dir, name))
+                future = lists.submit(scrape_list, url, fetcher.fork(),
+                    results=results, tree=tree, log=log, **params)
+                futures.append(future)
+        fetcher.policy.report()
+        log.report()
+        error = None
+        for [url, future] in zip(urls, futures):
+            if future.exception() is not None:
+                print("Failed:", url, repr(future.exception()), file=stderr)
+                error = error or future.exception()
+        if error is not None:
+            raise error
+
+def list_file_name(url, names):
+    '''Chooses a CSV file name for a list, different to any in "names"'''
+    path = urllib.parse.urlsplit(url)
+    name = path.path.rstrip("/").rsplit("/", 1)[-1] or path.hostname
+    name = re.sub(r"[^\w.-]+", "_", name).strip("._") or "list"
+    unique = name
+    suffix = 1
+    while unique in names:
+        suffix += 1
+        unique = "{}-{}".format(name, suffix)
+    names.add(unique)
+    return unique + os.extsep + "csv"
+
+def scrape_list(url, fetcher, *, out=None, output=None,
+        results=None, tree=False, log=None):
+    '''Scrapes all the pages of a list
+    
+    The rows are written to "out", or to the CSV file named by "output",
+    with a checkpoint. PageMetrics for each page are added to "log".'''
+    with ExitStack() as cleanup:
+        if output is None:
+            checkpoint = None
+            resume = None
+        else:
+            checkpoint = Checkpoint(output + os.extsep + "checkpoint")
+            resume = checkpoint.load(url)
+            if resume is None:
+                mode = "w"
+            else:
+                os.truncate(output, resume["size"])
+                mode = "a"
+            file = open(output, mode, encoding="utf-8", newline="")
+            cleanup.enter_context(file)
+            out = CsvOutput(file)
         
-        first = True
-        total = 0
+        start = url
+        counter = None
+        urls = [url]
+        if resume is not None:
+            out.header = tuple(resume["header"])
+            out.total = resume["total"]
+            counter = resume["counter"]
+            per_page = resume["per_page"]
+            urls = [resume["previous"], resume["next"]]
+            url = resume["next"]
+            print("Resuming at", url, file=stderr)
         while True:
-            with ExitStack() as cleanup:
-                [msg, response] = get_cached(url, urlopen, cleanup)
-                
-                for encoding in header_list(msg, "Content-Encoding"):
-                    if encoding.lower() in {"gzip", "x-gzip"}:
-                        if isinstance(response, GzipFile):
-                            raise TypeError("Recursive gzip encoding")
-                        response = GzipFile(fileobj=response, mode="rb")
-                    else:
-                        msg = "Unhandled encoding: " + repr(encoding)
-                        raise TypeError(msg)
-                
-                charset = msg.get_content_charset()
-                response = TextIOWrapper(response, charset)
-                parser = HtmlTreeParser()
-                print(end="Parsing HTML ", flush=True, file=stderr)
-                # TODO: limit data
-                copyfileobj(response, DelegateWriter(parser.feed))
-                print("done", flush=True, file=stderr)
-            response = parser.close()
+            started = time.monotonic()
+            rows = out.total
+            with ExitStack() as page_cleanup:
+                [header, response, digest, metrics] = fetcher.get(url,
+                    page_cleanup)
+                page = None
+                if results is not None:
+                    page = results.get(digest)
+                if page is None:
+                    page = scrape_page(header, response, out, tree=tree,
+                        results=results, digest=digest, metrics=metrics)
+                else:
+                    print("Parsed before", file=stderr)
+                    page.replay(out)
+            metrics.rows = out.total - rows
+            metrics.total = time.monotonic() - started
+            if log is not None:
+                log.add(metrics)
             
-            [page_counter] = response.iterfind(
-                ".//*[@class='mpcCounter']")
-            page_counter = int("".join(page_counter.itertext()))
-            page_header = tuple(scrape_header(response))
-            if first:
-                counter = page_counter
+            if counter is None:
+                counter = page.counter
                 print("Total records: " + format(counter), file=stderr)
-                header = page_header
-                out.writerow(header)
-                first = False
-            assert page_counter == counter
-            assert page_header == header
-            for row in scrape_records(response):
-                total += 1
-                assert len(row) == len(header)
-                out.writerow(row)
-            links = response.iterfind(".//link[@rel='next']")
+            assert page.counter == counter
+            if len(urls) == 1:
+                per_page = out.total
+            url = page.next
+            if url is None:
+                break
+            
+            if checkpoint is not None:
+                file.flush()
+                checkpoint.save(start=start,
+                    previous=urls[-1], next=url, header=out.header,
+                    total=out.total, counter=counter, per_page=per_page,
+                    size=file.tell())
+            urls.append(url)
+            if per_page:
+                remaining = -(-(counter - out.total) // per_page) - 1
+            else:
+                remaining = 0
+            fetcher.prefetch(predict_urls(*urls[-2:], remaining))
+        assert out.total == counter
+        if checkpoint is not None:
+            checkpoint.remove()
+
+def scrape_page(header, response, out, *, tree=False,
+        results=None, digest=None, metrics=None):
+    '''Parses a page, writing its header and rows to "out"
+    
+    Returns an object with "counter" and "next" attributes. If
+    "metrics" is given, its "decoded" and "parse" attributes are set,
+    excluding any time spent reading the response.'''
+    if metrics is not None:
+        started = time.monotonic()
+        download = metrics.download
+    if results is not None:
+        out = ScrapedPage(out)
+    if tree:
+        parser = HtmlTreeParser()
+    else:
+        parser = PageScraper(out)
+    print(end="Parsing HTML ", flush=True, file=stderr)
+    # TODO: limit data
+    decoded = feed_text(header, response, parser.feed)
+    print("done", flush=True, file=stderr)
+    if tree:
+        page = scrape_tree(parser.close(), out)
+    else:
+        page = parser
+        page.close()
+    if metrics is not None:
+        metrics.decoded = decoded
+        metrics.parse = time.monotonic() - started
+        metrics.parse -= metrics.download - download
+    if results is not None:
+        out.counter = page.counter
+        out.next = page.next
+        results.add(digest, out)
+    return page
+
+class ScrapedPage:
+    '''Records what is scraped from a page, and passes it on to "out"'''
+    
+    def __init__(self, out=None):
+        self._out = out
+        self.header = None
+        self.rows = list()
+    
+    def page_header(self, header):
+        self.header = header
+        self._out.page_header(header)
+    
+    def row(self, row):
+        self.rows.append(row)
+        self._out.row(row)
+    
+    def replay(self, out):
+        out.page_header(self.header)
+        for row in self.rows:
+            out.row(row)
+
+class ResultCache:
+    '''Saves the results of scraping pages in an SQLite database'''
+    
+    VERSION = 1  # Increase when the scraped output changes
+    
+    def __init__(self, path):
+        import sqlite3
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS results (
+                    hash BLOB, version INTEGER, data BLOB NOT NULL,
+                    PRIMARY KEY (hash, version))''')
+    
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self._db.close()
+    
+    def get(self, digest):
+        '''Returns a ScrapedPage, or None if the page is not known'''
+        with self._lock:
+            row = self._db.execute('''
+                SELECT data FROM results WHERE hash = ? AND version = ?''',
+                (digest, self.VERSION)).fetchone()
+        if row is None:
+            return None
+        [data] = row
+        data = json.loads(zlib.decompress(data))
+        page = ScrapedPage()
+        page.header = tuple(data["header"])
+        page.rows = data["rows"]
+        page.counter = data["counter"]
+        page.next = data["next"]
+        return page
+    
+    def add(self, digest, page):
+        data = dict(header=page.header, rows=page.rows,
+            counter=page.counter, next=page.next)
+        data = zlib.compress(json.dumps(data).encode())
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                (digest, self.VERSION, data))
+
+class Checkpoint:
+    '''Records the progress of a crawl in a JSON file'''
+    
+    def __init__(self, path):
+        self.path = path
+    
+    def load(self, start):
+        '''Returns the saved progress, or None if there is none
+        
+        Raises ValueError if the checkpoint is for a different starting
+        URL.'''
+        try:
+            file = open(self.path, "r", encoding="utf-8")
+        except FileNotFoundError:
+            return None
+        with file:
+            state = json.load(file)
+        if state["start"] != start:
+            msg = "Checkpoint {!r} is for {!r}"
+            raise ValueError(msg.format(self.path, state["start"]))
+        return state
+    
+    def save(self, **state):
+        [dir, name] = os.path.split(self.path)
+        new = NamedTemporaryFile("w", encoding="utf-8", delete=False,
+            dir=dir or os.curdir, prefix=name + "~")
+        try:
+            with new:
+                json.dump(state, new)
+            os.replace(new.name, self.path)
+        except:
+            os.unlink(new.name)
+            raise
+    
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+class CsvOutput:
+    '''Writes the header once, and checks each page against it'''
+    
+    def __init__(self, out):
+        self._writer = csv.writer(out)
+        self.header = None
+        self.total = 0
+    
+    def page_header(self, header):
+        if self.header is None:
+            self.header = header
+            self._write_header(header)
+        assert header == self.header
+    
+    def row(self, row):
+        self.total += 1
+        assert len(row) == len(self.header)
+        self._write_row(row)
+    
+    def _write_header(self, header):
+        self._writer.writerow(header)
+    
+    def _write_row(self, row):
+        self._writer.writerow(row)
+
+class CombinedOutput:
+    '''Writes several lists to one CSV file, with a "category" column
+    
+    The lists may be written from separate threads.'''
+    
+    def __init__(self, out):
+        self.writer = csv.writer(out)
+        self.lock = threading.Lock()
+        self.header = None
+    
+    def category(self, name):
+        '''Returns a CsvOutput-like object for one list'''
+        return _CategoryOutput(self, name)
+
+class _CategoryOutput(CsvOutput):
+    def __init__(self, combined, name):
+        self._combined = combined
+        self._name = name
+        self.header = None
+        self.total = 0
+    
+    def _write_header(self, header):
+        with self._combined.lock:
+            if self._combined.header is None:
+                self._combined.header = header
+                self._combined.writer.writerow(("category",) + header)
+            assert header == self._combined.header
+    
+    def _write_row(self, row):
+        with self._combined.lock:
+            self._combined.writer.writerow([self._name] + list(row))
+
+def predict_urls(previous, next, count):
+    '''Guesses the URLs of pages following "next"
+    
+    The URLs must differ only by one number, which is assumed to
+    increase by the same amount for each page.'''
+    previous = _DIGITS.split(previous)
+    next = _DIGITS.split(next)
+    if len(previous) != len(next):
+        return
+    differ = [i for [i, [a, b]] in enumerate(zip(previous, next)) if a != b]
+    if len(differ) != 1 or not differ[0] % 2:
+        return
+    [i] = differ
+    step = int(next[i]) - int(previous[i])
+    if step <= 0:
+        return
+    for n in range(count):
+        next[i] = format(int(next[i]) + step)
+        yield "".join(next)
+
+_DIGITS = re.compile(r"(\d+)")
+
+class Fetcher:
+    '''Gets pages through the cache, and optionally fetches them ahead
+    
+    Each thread has its own persistent connection.'''
+    
+    def __init__(self, connections=1, cache=None, max_age=None, *,
+            digest=False, limits=None):
+        self._cleanup = ExitStack()
+        self._hash = digest
+        self._limits = limits
+        self.policy = CachePolicy(max_age)
+        if cache is None:
+            self._get_cached = get_cached
+        else:
+            cache = self._cleanup.enter_context(PageCache(cache))
+            self._get_cached = cache.get
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._ahead = 2 * connections
+        self._pending = dict()  # Future for each URL being fetched ahead
+        if connections > 1:
+            self._pool = ThreadPoolExecutor(connections)
+            self._cleanup.callback(self._pool.shutdown, cancel_futures=True)
+        else:
+            self._pool = None
+    
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self._cleanup.close()
+    
+    def get(self, url, cleanup):
+        '''Returns the header, a binary stream, a digest and PageMetrics
+        
+        The stream may still be compressed according to the header; see
+        feed_text(). The digest is the SHA-256 hash of the body as
+        received, or None if not enabled.'''
+        future = self._pending.pop(url, None)
+        if future is None and self._pool is not None:
+            future = self._pool.submit(self._fetch, url)
+        if future is not None:
+            [msg, body, digest, metrics] = future.result()
+            return (msg, BytesIO(body), digest, metrics)
+        metrics = PageMetrics(url, self.policy)
+        [msg, response] = self._get_cached(url,
+            self._urlopen(url, cleanup, metrics), cleanup, metrics)
+        [response, digest] = self._digest(TimedReader(response, metrics))
+        return (msg, response, digest, metrics)
+    
+    def fork(self):
+        '''Returns a Fetcher for another list, sharing this one's pool
+        
+        Only the original Fetcher needs to be closed.'''
+        fork = copy.copy(self)
+        fork._pending = dict()
+        return fork
+    
+    def prefetch(self, urls):
+        '''Replaces any pages being fetched ahead'''
+        if self._pool is None:
+            return
+        pending = dict()
+        for url in islice(urls, self._ahead):
+            future = self._pending.pop(url, None)
+            if future is None:
+                future = self._pool.submit(self._fetch, url)
+            pending[url] = future
+        for future in self._pending.values():
+            future.cancel()
+        self._pending = pending
+    
+    def _fetch(self, url):
+        metrics = PageMetrics(url, self.policy)
+        with ExitStack() as cleanup:
+            [msg, response] = self._get_cached(url,
+                self._urlopen(url, cleanup, metrics), cleanup, metrics)
+            response = TimedReader(response, metrics)
+            [response, digest] = self._digest(response)
+            body = decompress(msg, response).read()
+        del msg["Content-Encoding"]
+        return (msg, body, digest, metrics)
+    
+    def _digest(self, response):
+        if not self._hash:
+            return (response, None)
+        body = response.read()
+        return (BytesIO(body), hashlib.sha256(body).digest())
+    
+    def _urlopen(self, url, cleanup, metrics):
+        try:
+            urlopen = self._local.urlopen
+        except AttributeError:
+            handler = PersistentConnectionHandler(timeout=100)
+            with self._lock:
+                self._cleanup.enter_context(handler)
+            urlopen = urllib.request.build_opener(handler).open
+            self._local.urlopen = urlopen
+        urlopen = metrics.time_urlopen(urlopen)
+        if self._limits is not None:
+            urlopen = self._limits.wrap(urlopen, url, cleanup)
+        return urlopen
+
+class PageMetrics:
+    '''Measurements of getting and scraping a page
+    
+    Also acts as the CachePolicy for the request, recording the outcome
+    before passing it on. Times are in seconds.'''
+    
+    def __init__(self, url, policy):
+        self.url = url
+        self._policy = policy
+        self.cache = None  # "hit", "revalidated" or "fetched"
+        self.ttfb = None  # Including connecting; None if no request
+        self.download = 0  # Reading the body, from the network or cache
+        self.received = 0  # Bytes before decompressing
+        self.decoded = None  # Bytes after decompressing, if parsed
+        self.parse = None  # Decoding and parsing; None if parsed before
+        self.rows = None
+        self.total = None
+    
+    def fresh(self, header, stored):
+        return self._policy.fresh(header, stored)
+    
+    def count(self, outcome):
+        self.cache = outcome
+        self._policy.count(outcome)
+    
+    def time_urlopen(self, urlopen):
+        '''Returns a version of "urlopen" that records "ttfb"'''
+        def timed(*pos, **kw):
+            started = time.monotonic()
             try:
-                url = next(links)
-            except StopIteration:
+                return urlopen(*pos, **kw)
+            finally:
+                self.ttfb = time.monotonic() - started
+        return timed
+    
+    def json(self):
+        return dict(url=self.url, cache=self.cache, ttfb=self.ttfb,
+            download=self.download, received=self.received,
+            decoded=self.decoded, parse=self.parse, rows=self.rows,
+            total=self.total)
+
+class TimedReader(BufferedIOBase):
+    '''Adds the time and bytes read from a stream to PageMetrics'''
+    
+    def readable(self):
+        return True
+    
+    def __init__(self, source, metrics):
+        self._source = source
+        self._metrics = metrics
+    
+    def read(self, *pos, **kw):
+        started = time.monotonic()
+        result = self._source.read(*pos, **kw)
+        self._metrics.download += time.monotonic() - started
+        self._metrics.received += len(result)
+        return result
+    
+    def readinto(self, b):
+        started = time.monotonic()
+        n = self._source.readinto(b)
+        self._metrics.download += time.monotonic() - started
+        self._metrics.received += n
+        return n
+
+class MetricsLog:
+    '''Collects PageMetrics, optionally appending them to a file'''
+    
+    def __init__(self, path=None):
+        self._lock = threading.Lock()
+        self._pages = list()
+        if path is None:
+            self._file = None
+        else:
+            self._file = open(path, "a", encoding="utf-8")
+    
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        if self._file is not None:
+            self._file.close()
+    
+    def add(self, metrics):
+        record = metrics.json()
+        record["time"] = time.time()
+        with self._lock:
+            self._pages.append(metrics)
+            if self._file is not None:
+                json.dump(record, self._file)
+                self._file.write("\n")
+                self._file.flush()
+    
+    def report(self):
+        '''Prints a summary table'''
+        pages = self._pages
+        print("Pages:", len(pages), file=stderr)
+        if not pages:
+            return
+        print("{:13} {:>6} {:>10} {:>10}".format("", "pages", "total",
+            "mean"), file=stderr)
+        for [label, name, format, scale] in (
+            ("Time", "total", "{:.3f} s", 1),
+            ("TTFB", "ttfb", "{:.3f} s", 1),
+            ("Download", "download", "{:.3f} s", 1),
+            ("Parse", "parse", "{:.3f} s", 1),
+            ("Received", "received", "{:.3f} MB", 1e-6),
+            ("Decompressed", "decoded", "{:.3f} MB", 1e-6),
+            ("Rows", "rows", "{:.1f}", 1),
+        ):
+            values = [getattr(page, name) for page in pages]
+            values = [value for value in values if value is not None]
+            if not values:
+                continue
+            total = sum(values) * scale
+            mean = total / len(values)
+            print("{:13} {:6} {:>10} {:>10}".format(label, len(values),
+                format.format(total), format.format(mean)), file=stderr)
+
+class HostLimits:
+    '''Limits the concurrency and rate of requests to each host'''
+    
+    def __init__(self, concurrency=None, rate=None):
+        self._concurrency = concurrency
+        if rate:
+            self._interval = 1 / rate
+        else:
+            self._interval = 0
+        self._lock = threading.Lock()
+        self._hosts = dict()  # Namespace of slots and next start time
+    
+    def wrap(self, urlopen, url, cleanup):
+        '''Returns a version of "urlopen" that waits for the host of "url"
+        
+        Once a request is started, it counts against the host until
+        "cleanup" is closed.'''
+        host = urllib.parse.urlsplit(url).netloc.lower()
+        def limited(*pos, **kw):
+            self._acquire(host)
+            cleanup.callback(self._release, host)
+            return urlopen(*pos, **kw)
+        return limited
+    
+    def _acquire(self, host):
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None:
+                state = SimpleNamespace(slots=None, next=0)
+                if self._concurrency:
+                    state.slots = threading.Semaphore(self._concurrency)
+                self._hosts[host] = state
+        if state.slots is not None:
+            state.slots.acquire()
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, state.next)
+            state.next = start + self._interval
+        time.sleep(start - now)
+    
+    def _release(self, host):
+        slots = self._hosts[host].slots
+        if slots is not None:
+            slots.release()
+
+def feed_text(header, response, feed):
+    '''Decompresses and decodes a response, passing the text to "feed"
+    
+    Equivalent to reading a TextIOWrapper around decompress(), but the
+    response is read into one reusable buffer, and each chunk is only
+    copied by decompressing and decoding it. Returns the number of bytes
+    after decompressing.'''
+    gzip = None
+    for encoding in header_list(header, "Content-Encoding"):
+        if encoding.lower() not in {"gzip", "x-gzip"}:
+            msg = "Unhandled encoding: " + repr(encoding)
+            raise TypeError(msg)
+        if gzip is not None:
+            raise TypeError("Recursive gzip encoding")
+        gzip = GzipDecoder()
+    charset = header.get_content_charset()
+    if charset is None:
+        charset = locale.getpreferredencoding(False)
+    decoder = codecs.getincrementaldecoder(charset)()
+    decoder = IncrementalNewlineDecoder(decoder, translate=True)
+    
+    decoded = 0
+    buffer = bytearray(READ_SIZE)
+    with memoryview(buffer) as view:
+        while True:
+            size = response.readinto(buffer)
+            if not size:
                 break
-            [] = links
-            url = url.get("href")
-        assert total == counter
+            data = view[:size]
+            if gzip is None:
+                chunks = (data,)
+            else:
+                chunks = gzip.decompress(data)
+            for chunk in chunks:
+                decoded += len(chunk)
+                text = decoder.decode(chunk)
+                if text:
+                    feed(text)
+    if gzip is not None:
+        gzip.close()
+    text = decoder.decode(b"", final=True)
+    if text:
+        feed(text)
+    return decoded
+
+READ_SIZE = 0x4000
+
+class GzipDecoder:
+    '''Incrementally decompresses gzip data, including multiple members'''
+    
+    def __init__(self):
+        self._new_member()
+    
+    def decompress(self, data):
+        '''Yields chunks of up to READ_SIZE bytes
+        
+        Smaller chunks are faster to decode than one large chunk.'''
+        while data:
+            self._started = True
+            yield self._decompressor.decompress(data, READ_SIZE)
+            data = self._decompressor.unconsumed_tail
+            if self._decompressor.eof:
+                data = self._decompressor.unused_data
+                self._new_member()
+    
+    def close(self):
+        '''Checks that the data did not end partway through a member'''
+        if self._started:
+            raise EOFError("Compressed file ended before the "
+                "end-of-stream marker was reached")
+    
+    def _new_member(self):
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._started = False
+
+def decompress(msg, response):
+    for encoding in header_list(msg, "Content-Encoding"):
+        if encoding.lower() in {"gzip", "x-gzip"}:
+            if isinstance(response, GzipFile):
+                raise TypeError("Recursive gzip encoding")
+            response = GzipFile(fileobj=response, mode="rb")
+        else:
+            msg = "Unhandled encoding: " + repr(encoding)
+            raise TypeError(msg)
+    return response
+
+def scrape_tree(response, out):
+    '''Scrapes a complete page tree
+    
+    Returns an object with "counter" and "next" attributes, like a
+    PageScraper.'''
+    [page_counter] = response.iterfind(".//*[@class='mpcCounter']")
+    page = SimpleNamespace(counter=int("".join(page_counter.itertext())))
+    out.page_header(tuple(scrape_header(response)))
+    for row in scrape_records(response):
+        out.row(row)
+    links = response.iterfind(".//link[@rel='next']")
+    page.next = next(links, None)
+    if page.next is not None:
+        [] = links
+        page.next = page.next.get("href")
+    return page
 
 def scrape_header(response):
     header = None
@@ -79,6 +821,9 @@ def scrape_header(response):
         if "srtnTblHeader" in elem.get("class").split():
             assert header is None
             header = elem
+    return scrape_header_table(header)
+
+def scrape_header_table(header):
     header = header.find(".//tr")
     header = ("".join(cell.itertext()).strip() for cell in header.iter("td"))
     
@@ -92,65 +837,130 @@ def scrape_header(response):
 
 def scrape_records(response):
     [table] = response.iterfind(".//table[@class='srtnListTbl']")
-    for [i, row] in enumerate(table.iterfind(".//tr")):
-        row = row.iterfind(".//td")
-        cell = next(row)
-        
-        [desc] = cell.iterfind(".//a[@class='tnProdDesc']")
-        out_row = [desc.get("href")]
-        out_row.append("".join(desc.itertext()).strip())
-        
-        pricing = None
-        for elem in cell.iterfind(".//span[1][@class]/.."):
-            if "price" in elem[0].get("class", "").split():
-                assert pricing is None
-                pricing = elem
-        pricing = iter(pricing)
-        out_row.append("".join(next(pricing).itertext()))
-        pricing = "".join(t for elem in pricing for t in elem.itertext())
-        [qty] = cell.iterfind(".//*[@class='qty']//input")
-        qty = int(qty.get("value"))
-        
-        per_item_prefix = "Each ("
-        per_item_suffix = ")"
-        if pricing == "Each":
-            out_row.extend((1, "Each", 1, qty))
-        elif pricing.startswith(per_item_prefix) \
-                and pricing.endswith(per_item_suffix):
-            pricing = pricing[len(per_item_prefix):-len(per_item_suffix)]
-            for prefix in ("In a ", "On a "):
-                if pricing.startswith(prefix):
-                    pricing = pricing[len(prefix):]
-                    break
-            [pricing, size] = pricing.rsplit(" of ", 1)
-            assert int(size) == qty
-            out_row.extend((1, pricing, size, 1))
+    for row in table.iterfind(".//tr"):
+        yield scrape_row(row)
+
+def scrape_row(row):
+    fields = RowFields()
+    fields.walk(row)
+    row = iter(fields.cells)
+    next(row)
+    
+    [desc] = fields.desc
+    out_row = [desc.get("href")]
+    out_row.append("".join(desc.itertext()).strip())
+    
+    [pricing] = fields.pricing
+    pricing = iter(pricing)
+    out_row.append("".join(next(pricing).itertext()))
+    pricing = "".join(t for elem in pricing for t in elem.itertext())
+    [qty] = fields.qty
+    qty = int(qty.get("value"))
+    
+    per_item_prefix = "Each ("
+    per_item_suffix = ")"
+    if pricing == "Each":
+        out_row.extend((1, "Each", 1, qty))
+    elif pricing.startswith(per_item_prefix) \
+            and pricing.endswith(per_item_suffix):
+        pricing = pricing[len(per_item_prefix):-len(per_item_suffix)]
+        for prefix in ("In a ", "On a "):
+            if pricing.startswith(prefix):
+                pricing = pricing[len(prefix):]
+                break
+        [pricing, size] = pricing.rsplit(" of ", 1)
+        assert int(size) == qty
+        out_row.extend((1, pricing, size, 1))
+    else:
+        prefix = "1 "
+        assert pricing.startswith(prefix)
+        [pricing, size] = pricing[len(prefix):].rsplit(" of ", 1)
+        out_row.extend((size, pricing, size, qty))
+    
+    next(row)
+    details = iter(fields.details)
+    for label in PART_DETAILS:
+        try:
+            detail = next(details)
+        except StopIteration:
+            assert label ==  "Mfr. Part No."
+            out_row.append(None)
         else:
-            prefix = "1 "
-            assert pricing.startswith(prefix)
-            [pricing, size] = pricing[len(prefix):].rsplit(" of ", 1)
-            out_row.extend((size, pricing, size, qty))
-        
-        cell = next(row)
-        details = cell.iterfind(".//li")
-        for label in PART_DETAILS:
-            try:
-                detail = next(details)
-            except StopIteration:
-                assert label ==  "Mfr. Part No."
-                out_row.append(None)
-            else:
-                assert "".join(detail[0].itertext()) == label
-                text = "".join(t
-                    for elem in detail[1:] for t in elem.itertext())
-                out_row.append(text.strip())
-        
-        out_row.extend("".join(cell.itertext()).strip() for cell in row)
-        yield out_row
+            assert "".join(detail[0].itertext()) == label
+            text = "".join(t
+                for elem in detail[1:] for t in elem.itertext())
+            out_row.append(text.strip())
+    
+    out_row.extend("".join(cell.itertext()).strip() for cell in row)
+    return out_row
 
 PART_DETAILS = ("RS Stock No.", "Brand", "Mfr. Part No.")
 
-def get_cached(url, urlopen, cleanup):
+class RowFields:
+    '''Collects the elements scrape_row() needs in one walk of a row
+    
+    Equivalent to these searches, where the first two are relative to
+    the row, and the rest are relative to the first or second cell:
+    
+    .//td  ->  cells
+    .//a[@class='tnProdDesc']  ->  desc
+    .//span[1][@class]/.. where the first child's class has "price"
+        ->  pricing
+    .//*[@class='qty']//input  ->  qty
+    .//li  ->  details'''
+    
+    def __init__(self):
+        self.cells = list()
+        self.desc = list()
+        self.pricing = list()
+        self.qty = list()
+        self.details = list()
+    
+    def walk(self, elem, first=False, second=False, qty=False):
+        if first:
+            self._check_pricing(elem)
+        for child in elem:
+            if not first and not second and len(self.cells) >= 2:
+                # Only further cells remain to be found
+                self.cells.extend(child.iter("td"))
+                continue
+            tag = child.tag
+            child_first = first
+            child_second = second
+            child_qty = qty
+            if tag == "td":
+                self.cells.append(child)
+                child_first |= len(self.cells) == 1
+                child_second |= len(self.cells) == 2
+            if first:
+                cls = child.get("class")
+                if tag == "a" and cls == "tnProdDesc":
+                    self.desc.append(child)
+                elif tag == "input" and qty:
+                    self.qty.append(child)
+                child_qty |= cls == "qty"
+            if second and tag == "li":
+                self.details.append(child)
+            self.walk(child, child_first, child_second, child_qty)
+    
+    def _check_pricing(self, elem):
+        if not len(elem) \
+                or "price" not in elem[0].get("class", "").split():
+            return
+        for child in elem:
+            if child.tag == "span":
+                if child.get("class") is not None:
+                    self.pricing.append(elem)
+                return
+
+def get_cached(url, urlopen, cleanup, policy=None):
+    '''Returns the header and body stream for a URL
+    
+    Responses are saved in files under the current directory. A saved
+    response that the CachePolicy considers stale is revalidated with a
+    conditional request.'''
+    if policy is None:
+        policy = CachePolicy()
     print(end="GET {} ".format(url), flush=True, file=stderr)
     path = url.split("/")
     dir = os.path.join(*path[:-1])
@@ -161,53 +971,332 @@ def get_cached(url, urlopen, cleanup):
     suffix += os.extsep
     metadata = os.path.join(dir, suffix + "mime")
     try:
-        metadata = open(metadata, "rb")
+        file = open(metadata, "rb")
     except FileNotFoundError:
-        os.makedirs(dir, exist_ok=True)
-        with open(metadata, "xb") as metadata:
-            types = ("text/html",)
-            response = http_request(url, types,
-                headers={"Accept-Encoding": "gzip, x-gzip"},
-                urlopen=urlopen)
-            cleanup.enter_context(response)
-            print(response.status, response.reason, flush=True, file=stderr)
-            
-            header = response.info()
-            for field in header_list(header, "Connection"):
-                del header[field]
-            for field in (
-                "Close", "Connection", "Content-Length", "Keep-Alive",
-                "Proxy-Authenticate", "Proxy-Authorization",
-                "Public",
-                "Transfer-Encoding", "TE", "Trailer",
-                "Upgrade",
-            ):
-                del header[field]
-            
-            suffix += "html"
-            for encoding in header_list(header, "Content-Encoding"):
-                if encoding.lower() in {"gzip", "x-gzip"}:
-                    suffix += os.extsep + "gz"
-                    break
-            cache = open(os.path.join(dir, suffix), "xb")
-            cleanup.enter_context(cache)
-            msg = Message()
-            msg.add_header("Content-Type",
-                "message/external-body; access-type=local-file",
-                name=suffix)
-            msg.attach(header)
-            metadata = email.generator.BytesGenerator(metadata,
+        cached = None
+    else:
+        with file:
+            stored = os.stat(file.fileno()).st_mtime
+            [cached, response] = read_cached(file, dir, cleanup)
+        if policy.fresh(cached, stored):
+            print("(cached)", flush=True, file=stderr)
+            policy.count("hit")
+            return (cached, response)
+    
+    headers = {"Accept-Encoding": "gzip, x-gzip"}
+    if cached is not None:
+        headers.update(conditional_fields(cached))
+    types = ("text/html",)
+    try:
+        new = http_request(url, types, headers=headers, urlopen=urlopen)
+    except HTTPError as err:
+        if cached is None or err.code != http.client.NOT_MODIFIED:
+            raise
+        err.close()
+        print(err.code, err.reason, flush=True, file=stderr)
+        update_fields(cached, err.headers)
+        write_metadata(metadata, os.path.basename(response.name), cached)
+        policy.count("revalidated")
+        return (cached, response)
+    cleanup.enter_context(new)
+    print(new.status, new.reason, flush=True, file=stderr)
+    
+    header = new.info()
+    strip_hop_fields(header)
+    suffix += "html"
+    for encoding in header_list(header, "Content-Encoding"):
+        if encoding.lower() in {"gzip", "x-gzip"}:
+            suffix += os.extsep + "gz"
+            break
+    os.makedirs(dir, exist_ok=True)
+    cache = open(os.path.join(dir, suffix), "wb")
+    cleanup.enter_context(cache)
+    write_metadata(metadata, suffix, header)
+    if cached is not None:
+        response.close()
+        if os.path.basename(response.name) != suffix:
+            os.unlink(response.name)
+    policy.count("fetched")
+    return (header, TeeReader(new, cache.write))
+
+def write_metadata(path, name, header):
+    '''Replaces a "mime" file describing the cached body file "name"'''
+    msg = Message()
+    msg.add_header("Content-Type",
+        "message/external-body; access-type=local-file", name=name)
+    msg.attach(header)
+    [dir, base] = os.path.split(path)
+    new = NamedTemporaryFile(delete=False,
+        dir=dir or os.curdir, prefix=base + "~")
+    try:
+        with new:
+            generator = email.generator.BytesGenerator(new,
                 mangle_from_=False, maxheaderlen=0)
-            metadata.flatten(msg)
-        return (header, TeeReader(response, cache.write))
-    with metadata:
-        msg = email.message_from_binary_file(metadata)
+            generator.flatten(msg)
+        os.replace(new.name, path)
+    except:
+        os.unlink(new.name)
+        raise
+
+class CachePolicy:
+    '''Decides when cached responses need revalidating
+    
+    Normally a response is fresh according to its Cache-Control,
+    Expires or Last-Modified fields, or for HEURISTIC_LIFETIME without
+    them. If "max_age" is given, it overrides
+    the fields: responses stored less than that many seconds ago are
+    fresh, and older ones are stale. Also counts how each request was
+    handled.'''
+    
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        self.counts = dict.fromkeys(("hit", "revalidated", "fetched"), 0)
+        self._lock = threading.Lock()
+    
+    def fresh(self, header, stored):
+        '''"Stored" is the time the response was received or revalidated'''
+        age = time.time() - stored
+        if self.max_age is not None:
+            return age < self.max_age
+        return age < freshness_lifetime(header, stored)
+    
+    def count(self, outcome):
+        with self._lock:
+            self.counts[outcome] += 1
+    
+    def report(self):
+        msg = "Cache: {hit} hit, {revalidated} revalidated, {fetched} fetched"
+        print(msg.format_map(self.counts), file=stderr)
+
+def freshness_lifetime(header, stored):
+    '''Returns the number of seconds a response is fresh for'''
+    directives = dict()
+    for directive in header_list(header, "Cache-Control"):
+        [name, _, value] = directive.partition("=")
+        directives[name.strip().lower()] = value.strip().strip('"')
+    if "no-cache" in directives or "no-store" in directives:
+        return 0
+    if "max-age" in directives:
+        try:
+            return int(directives["max-age"])
+        except ValueError:
+            return 0
+    date = http_date(header["Date"])
+    if date is None:
+        date = stored
+    if header["Expires"] is not None:
+        expires = http_date(header["Expires"])
+        if expires is None:
+            return 0  # Invalid dates mean already expired
+        return expires - date
+    # Heuristics allowed by RFC 9111
+    modified = http_date(header["Last-Modified"])
+    if modified is not None:
+        return (date - modified) / 10
+    return HEURISTIC_LIFETIME
+
+HEURISTIC_LIFETIME = 60 * 60  # Seconds, with no freshness information
+
+def http_date(value):
+    if value is None:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+def conditional_fields(header):
+    '''Returns request fields to revalidate a cached response'''
+    fields = dict()
+    if header["ETag"] is not None:
+        fields["If-None-Match"] = header["ETag"]
+    if header["Last-Modified"] is not None:
+        fields["If-Modified-Since"] = header["Last-Modified"]
+    return fields
+
+def update_fields(cached, new):
+    '''Updates a cached header from a "304 Not Modified" response'''
+    strip_hop_fields(new)
+    for field in set(new.keys()):
+        del cached[field]
+        for value in new.get_all(field):
+            cached[field] = value
+
+def strip_hop_fields(header):
+    '''Deletes header fields that only apply to a single connection'''
+    for field in header_list(header, "Connection"):
+        del header[field]
+    for field in (
+        "Close", "Connection", "Content-Length", "Keep-Alive",
+        "Proxy-Authenticate", "Proxy-Authorization",
+        "Public",
+        "Transfer-Encoding", "TE", "Trailer",
+        "Upgrade",
+    ):
+        del header[field]
+
+def read_cached(metadata, dir, cleanup):
+    '''Opens a response saved by get_cached()
+    
+    The "metadata" parameter is the open "mime" file, and "dir" is the
+    directory that it is in.'''
+    msg = email.message_from_binary_file(metadata)
     cache = os.path.join(dir, msg.get_param("name"))
     [msg] = msg.get_payload()
     response = cleanup.enter_context(open(cache, "rb"))
-    print("(cached)", flush=True, file=stderr)
     return (msg, response)
 
+class PageCache:
+    '''Caches responses in a single SQLite database
+    
+    An alternative to the tree of files written by get_cached(). Bodies
+    are stored decoded, compressed with zlib, and shared between URLs by
+    their SHA-256 hash. Usable from multiple threads.'''
+    
+    def __init__(self, path):
+        import sqlite3
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.executescript('''
+                CREATE TABLE IF NOT EXISTS bodies (
+                    hash BLOB PRIMARY KEY, data BLOB NOT NULL);
+                CREATE TABLE IF NOT EXISTS urls (
+                    url TEXT PRIMARY KEY, header BLOB NOT NULL,
+                    hash BLOB NOT NULL REFERENCES bodies,
+                    stored REAL NOT NULL DEFAULT 0);
+                CREATE INDEX IF NOT EXISTS urls_hash ON urls (hash);
+            ''')
+            columns = self._db.execute("PRAGMA table_info(urls)")
+            if "stored" not in {column[1] for column in columns}:
+                # Responses from before this column was added are
+                # treated as stale
+                self._db.execute("ALTER TABLE urls"
+                    " ADD COLUMN stored REAL NOT NULL DEFAULT 0")
+    
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self._db.close()
+    
+    def get(self, url, urlopen, cleanup, policy=None):
+        '''Same as get_cached()'''
+        if policy is None:
+            policy = CachePolicy()
+        print(end="GET {} ".format(url), flush=True, file=stderr)
+        with self._lock:
+            cached = self._db.execute('''
+                SELECT header, data, stored FROM urls NATURAL JOIN bodies
+                WHERE url = ?''', (url,)).fetchone()
+        headers = {"Accept-Encoding": "gzip, x-gzip"}
+        if cached is not None:
+            [header, data, stored] = cached
+            cached = email.message_from_bytes(header)
+            if policy.fresh(cached, stored):
+                print("(cached)", flush=True, file=stderr)
+                policy.count("hit")
+                return (cached, BytesIO(zlib.decompress(data)))
+            headers.update(conditional_fields(cached))
+        
+        types = ("text/html",)
+        try:
+            response = http_request(url, types, headers=headers,
+                urlopen=urlopen)
+        except HTTPError as err:
+            if cached is None or err.code != http.client.NOT_MODIFIED:
+                raise
+            err.close()
+            print(err.code, err.reason, flush=True, file=stderr)
+            # The body is stored decoded, so keep the fields describing that
+            for field in DECODED_FIELDS:
+                del err.headers[field]
+            update_fields(cached, err.headers)
+            with self._lock, self._db:
+                self._db.execute(
+                    "UPDATE urls SET header = ?, stored = ? WHERE url = ?",
+                    (cached.as_bytes(), time.time(), url))
+            policy.count("revalidated")
+            return (cached, BytesIO(zlib.decompress(data)))
+        with response:
+            print(response.status, response.reason, flush=True, file=stderr)
+            header = response.info()
+            body = decompress(header, response).read()
+        strip_hop_fields(header)
+        del header["Content-Encoding"]
+        self.add(url, header, body)
+        policy.count("fetched")
+        return (header, BytesIO(body))
+    
+    def add(self, url, header, body, stored=None):
+        '''Stores a decoded response, replacing any for the same URL'''
+        if stored is None:
+            stored = time.time()
+        hash = hashlib.sha256(body).digest()
+        data = zlib.compress(body)
+        with self._lock, self._db:
+            old = self._db.execute("SELECT hash FROM urls WHERE url = ?",
+                (url,)).fetchone()
+            self._db.execute("INSERT OR IGNORE INTO bodies VALUES (?, ?)",
+                (hash, data))
+            self._db.execute(
+                "INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?)",
+                (url, header.as_bytes(), hash, stored))
+            if old is not None and old[0] != hash:
+                # Drop the previous body unless another URL shares it
+                self._db.execute('''
+                    DELETE FROM bodies WHERE hash = ? AND NOT EXISTS
+                        (SELECT * FROM urls WHERE hash = ?)''',
+                    (old[0], old[0]))
+    
+    def import_dir(self, dir=os.curdir):
+        '''Adds the responses from a tree written by get_cached()
+        
+        The URLs are reconstructed from the file paths, relative to
+        "dir", which should be the directory that the crawl was run
+        from. Returns the number of responses imported.'''
+        count = 0
+        for [path, _, files] in os.walk(dir):
+            for name in files:
+                if not name.endswith(os.extsep + "mime"):
+                    continue
+                url = cached_url(os.path.relpath(path, dir), name)
+                if url is None:
+                    print("Skipping", os.path.join(path, name), file=stderr)
+                    continue
+                with ExitStack() as cleanup:
+                    with open(os.path.join(path, name), "rb") as metadata:
+                        stored = os.stat(metadata.fileno()).st_mtime
+                        [header, response] = read_cached(metadata, path,
+                            cleanup)
+                    body = decompress(header, response).read()
+                del header["Content-Encoding"]
+                self.add(url, header, body, stored)
+                count += 1
+        return count
+
+# Fields of a 304 response that would not apply to a decoded body
+DECODED_FIELDS = ("Content-Encoding", "Content-Length", "Transfer-Encoding")
+
+def import_cache(db, dir=os.curdir):
+    '''Copies the tree of cached files into an SQLite page cache'''
+    with PageCache(db) as cache:
+        count = cache.import_dir(dir)
+    print("Imported", count, "responses", file=stderr)
+
+def cached_url(dir, name):
+    '''Reverses the file naming of get_cached()
+    
+    Returns None if the name does not match the URL's hash.'''
+    [name, _] = name.rsplit(os.extsep, 1)
+    [*last, suffix] = name.rsplit(os.extsep, 1)
+    [scheme, *path] = dir.split(os.sep)
+    url = "/".join([scheme, "", *path, *last] if last else
+        [scheme, "", *path, ""])
+    expected = hashlib.md5(url.encode()).digest()[:6]
+    if urlsafe_b64encode(expected).decode("ascii") != suffix:
+        return None
+    return url
+
 class HtmlTreeParser(HTMLParser):
     def __init__(self):
         super().__init__()
@@ -224,6 +1313,90 @@ class HtmlTreeParser(HTMLParser):
     def handle_data(self, *pos, **kw):
         self._builder.data(*pos, **kw)
 
+class PageScraper(HTMLParser):
+    '''Scrapes a page while it is parsed, without keeping a tree
+    
+    Only the header table, the counter, and one listing row at a time are
+    built as trees, with the same structure as HtmlTreeParser would give
+    them. Each row is passed to out.row() as soon as it ends. After
+    closing, the "counter" and "next" attributes are set.'''
+    
+    def __init__(self, out):
+        super().__init__()
+        self._out = out
+        self.counter = None
+        self.next = None
+        self._counters = 0
+        self._nexts = 0
+        self._headers = 0
+        self._tables = 0
+        self._depth = 0
+        self._table = None  # Depth of the listing table while inside it
+        self._row = None  # Capture for a listing row
+        self._captures = list()  # [depth, TreeBuilder, handler]
+    
+    def close(self):
+        super().close()
+        assert self._counters == 1
+        assert self._nexts <= 1
+        assert self._headers == 1
+        assert self._tables == 1
+    
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        self._depth += 1
+        for [_, builder, _] in self._captures:
+            builder.start(tag, attrs)
+        
+        cls = attrs.get("class")
+        if tag == "table" and cls == "srtnListTbl":
+            self._tables += 1
+            if self._table is None:
+                self._table = self._depth
+        elif tag == "tr" and self._table is not None and self._row is None:
+            self._row = self._capture(tag, attrs, self._end_row)
+        if tag == "table" and cls is not None \
+                and "srtnTblHeader" in cls.split():
+            self._headers += 1
+            self._capture(tag, attrs, self._end_header)
+        if cls == "mpcCounter":
+            self._counters += 1
+            self._capture(tag, attrs, self._end_counter)
+        if tag == "link" and attrs.get("rel") == "next":
+            self._nexts += 1
+            self.next = attrs.get("href")
+    
+    def handle_endtag(self, tag):
+        for [_, builder, _] in self._captures:
+            builder.end(tag)
+        while self._captures and self._captures[-1][0] == self._depth:
+            [_, builder, handler] = self._captures.pop()
+            handler(builder.close())
+        if self._table == self._depth:
+            self._table = None
+        self._depth -= 1
+    
+    def handle_data(self, data):
+        for [_, builder, _] in self._captures:
+            builder.data(data)
+    
+    def _capture(self, tag, attrs, handler):
+        builder = TreeBuilder()
+        builder.start(tag, attrs)
+        capture = [self._depth, builder, handler]
+        self._captures.append(capture)
+        return capture
+    
+    def _end_row(self, row):
+        self._row = None
+        self._out.row(scrape_row(row))
+    
+    def _end_header(self, table):
+        self._out.page_header(tuple(scrape_header_table(table)))
+    
+    def _end_counter(self, counter):
+        self.counter = int("".join(counter.itertext()))
+
 def dump_tree(tree, _indent=""):
     if not isinstance(stdout, TextIOWrapper):
         _dump_element(stdout, tree, "")
@@ -260,12 +1433,12 @@ class TeeReader(BufferedIOBase):
         return result
     
     def readinto(self, b):
-        n = self._readinto(b)
+        n = self._source.readinto(b)
         with memoryview(b) as view, view.cast("B") as bytes:
             self._call_write(bytes[:n])
         return n
     def readinto1(self, b):
-        n = self._readinto(b)
+        n = self._source.readinto1(b)
         with memoryview(b) as view, view.cast("B") as bytes:
             self._call_write(bytes[:n])
         return n
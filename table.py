@@ -1,38 +1,69 @@
 #! /usr/bin/env python3
 
 import csv
-from sys import stdin
+from sys import stdin, stdout
 import tkinter
 from tkwrap import Tree, scroll
-from tkinter.ttk import Frame, Entry
-from data import rewrap
+from tkinter.ttk import Frame, Entry, Scrollbar, Style
+import tkinter.font
+from data import rewrap, Filter, filter_index, filter_test, FILTER_MODES
 from types import SimpleNamespace
 import math
+from itertools import islice
+from contextlib import ExitStack
+from array import array
+import mmap
+import os, os.path
+from warnings import warn
+from tempfile import NamedTemporaryFile, TemporaryFile
+import ast
+import re
+from threading import Thread
+from queue import Queue, Empty
+from time import monotonic
+import stat
+import heapq
+from bisect import bisect_right
+from functions import attributes
 
 class main:
-    def __init__(self, input=None, *, field=()):
+    def __init__(self, input=None, *,
+            field=(), virtual=False, index=False, stream=False):
+        if index:
+            if input is None:
+                raise ValueError("Row index needs an input file")
+            virtual = True
+        
         self.tk = tkinter.Tk()
         self.entry = Entry(self.tk)
         self.entry.pack(fill=tkinter.BOTH, side=tkinter.TOP)
         view_frame = Frame(self.tk)
         view_frame.pack(fill=tkinter.BOTH, side=tkinter.BOTTOM, expand=True)
         
-        if input is None:
-            input = rewrap(stdin, newline="")
-        else:
-            input = open(input, "rt", newline="")
-        with input as input:
-            self.tk.wm_title(input.name)
-            input = csv.reader(input)
+        with ExitStack() as cleanup:
+            file = cleanup.enter_context(open_input(input))
+            self.title = file.name
+            self.tk.wm_title(self.title)
+            if index:
+                self.rows = MappedRows(file.name, file.encoding)
+                cleanup.enter_context(self.rows)
+            input = csv.reader(file)
             headings = next(input)
             columns = list()
             for heading in headings:
                 columns.append(dict(heading=heading, width=10))
+            self.headings = headings
+            self.fields = list()
             for heading in field:
-                [heading, _] = heading.split("=", 1)
+                [heading, expr] = heading.split("=", 1)
                 columns.append(dict(heading=heading, width=10))
+                self.fields.append(Field(heading, expr, headings))
             self.view = Tree(view_frame, tree=False, columns=columns)
-            scroll(self.view)
+            if virtual:
+                self.window = RowWindow(self.view, self.get_values)
+            else:
+                self.window = None
+                scroll(self.view)
             self.view.bind("<ButtonPress-1>", self.on_press)
             self.view.bind("<B1-Motion>", self.on_drag)
             self.view.bind("<ButtonRelease-1>", self.on_release)
@@ -40,25 +71,158 @@ class main:
             self.view.bind("<ButtonPress-3>", self.on_context)
             self.view.focus_set()
             
+            self.order = range(0)
+            self.sort_keys = list()  # Sequence of (column, descending)
+            self.mapped_ranks = dict()
+            self.filters = dict()  # (mode, text) for each column number
+            self.mapped_indexes = dict()
             self.items = list()
-            for record in input:
-                row = SimpleNamespace()
-                for [heading, value] in zip(headings, record):
-                    num = value
-                    if num.startswith("$"):
-                        num = num[1:]
-                    try:
-                        value = float(num)
-                    except ValueError:
-                        pass
-                    setattr(row, heading.replace(" ", "_"), value)
-                env = dict(row=row, math=math)
-                for expr in field:
-                    [_, expr] = expr.split("=", 1)
-                    record.append(eval(expr, env))
-                self.items.append(self.view.add(values=record))
-        
-        self.tk.mainloop()
+            if index:
+                self.show(range(len(self.rows)))
+            else:
+                self.rows = ColumnStore(len(headings), len(self.fields))
+                self.reader = input
+                if stream:
+                    # Read on another thread so that a slow pipe does not
+                    # block the user interface
+                    self.queue = Queue(STREAM_QUEUE)
+                    self.progress = None
+                    thread = Thread(target=self.read_records,
+                        args=(file,), daemon=True)
+                    thread.start()
+                    self.poll()
+                elif virtual:
+                    # Parse in chunks from the event loop so that the first
+                    # screen is shown before the whole file has been read
+                    self.load_more()
+                else:
+                    self.add_rows(self.reader)
+            
+            self.tk.mainloop()
+    
+    def evaluate(self, values):
+        '''Evaluates the --field expressions for the values of a row'''
+        return [field.evaluate_row(values) for field in self.fields]
+    
+    def add_rows(self, records):
+        start = len(self.rows)
+        count = self.rows.load(records, self.fields)
+        if not self.window:
+            for row in range(start, len(self.rows)):
+                self.items.append(self.view.add(values=self.rows[row]))
+        if isinstance(self.order, range):
+            self.order = range(len(self.rows))
+        else:
+            self.order = self.insert_rows(range(start, len(self.rows)))
+        if self.window:
+            self.window.order = self.order
+            self.window.refresh()
+        elif not isinstance(self.order, range):
+            items = (self.items[row] for row in self.order)
+            self.view.set_children("", *items)
+        return count
+    
+    def insert_rows(self, rows):
+        '''Returns the order with new rows added, filtered and sorted'''
+        for [column, [mode, text]] in self.filters.items():
+            test = filter_test(mode, text)
+            column = self.rows.columns[column]
+            rows = [row for row in rows if test(column.text(row))]
+        if not self.sort_keys:
+            return list(self.order) + list(rows)
+        # Ranking the whole column again would take time for every row
+        # loaded so far, so find where each new row goes by its text
+        columns = [(self.rows.columns[column], descending)
+            for [column, descending] in self.sort_keys]
+        # Searching the whole order each time means the first few rows
+        # compared are the same, so their keys are kept
+        keys = dict()
+        def key(row):
+            result = keys.get(row)
+            if result is None:
+                result = tuple(_Descending(alnum_key(column.text(row)))
+                    if descending else alnum_key(column.text(row))
+                    for [column, descending] in columns)
+                keys[row] = result
+            return result
+        order = list()
+        start = 0
+        for row in sorted(rows, key=key):
+            # After equal rows, which have lower row numbers
+            stop = bisect_right(self.order, key(row), key=key)
+            order.extend(self.order[start:stop])
+            order.append(row)
+            start = stop
+        order.extend(self.order[start:])
+        return order
+    
+    def load_more(self):
+        if self.add_rows(islice(self.reader, LOAD_CHUNK)) == LOAD_CHUNK:
+            self.tk.after_idle(self.load_more)
+    
+    def read_records(self, file):
+        '''Queues batches of records, with the fraction of the file read'''
+        try:
+            info = os.fstat(file.fileno())
+            if stat.S_ISREG(info.st_mode) and info.st_size:
+                size = info.st_size
+            else:
+                size = None
+            batch = list()
+            flushed = monotonic()
+            for record in self.reader:
+                batch.append(record)
+                if len(batch) >= STREAM_BATCH \
+                        or monotonic() - flushed >= STREAM_INTERVAL:
+                    if size is None:
+                        progress = None
+                    else:
+                        progress = file.buffer.tell() / size
+                    self.queue.put((batch, progress))
+                    batch = list()
+                    flushed = monotonic()
+            self.queue.put((batch, 1))
+            self.queue.put(None)
+        except BaseException as err:
+            self.queue.put(err)
+    
+    def poll(self):
+        deadline = monotonic() + STREAM_INTERVAL
+        while monotonic() < deadline:
+            try:
+                batch = self.queue.get_nowait()
+            except Empty:
+                break
+            if batch is None:
+                self.tk.wm_title(self.title)
+                return
+            if isinstance(batch, BaseException):
+                self.tk.wm_title(self.title)
+                raise batch
+            [batch, self.progress] = batch
+            self.add_rows(batch)
+        msg = "{} (loading, {} rows".format(self.title, len(self.rows))
+        if self.progress is not None:
+            msg += ", {:.0%}".format(self.progress)
+        self.tk.wm_title(msg + ")")
+        self.tk.after(STREAM_POLL, self.poll)
+    
+    def get_values(self, row):
+        if isinstance(self.rows, MappedRows):
+            # Pad or cut ragged records to line up with the headings
+            record = self.rows[row][:len(self.headings)]
+            record += [""] * (len(self.headings) - len(record))
+            return record + self.evaluate(list(map(parse_value, record)))
+        return self.rows[row]
+    
+    def show(self, order):
+        self.order = order
+        if self.window:
+            self.window.order = order
+            self.window.top = 0
+            self.window.refresh()
+        else:
+            self.view.set_children("", *(self.items[row] for row in order))
     
     def on_press(self, event):
         self.click = self.get_click(event)
@@ -77,17 +241,109 @@ class main:
             self.entry.focus_set()
         if region == "heading":
             [column] = click
-            def key(item):
-                return alnum_key(self.view.set(item, column))
-            items = sorted(self.view.get_children(), key=key)
-            self.view.set_children("", *items)
+            column = int(column.lstrip("#")) - 1
+            self.sort(column, add=event.state & SHIFT_MASK)
+    
+    def sort(self, column, add=False):
+        '''Sorts by a column, or adds it as a secondary sort key
+        
+        Sorting the same single column again reverses the order.'''
+        for [i, [sorted_column, descending]] in enumerate(self.sort_keys):
+            if sorted_column == column:
+                if add or len(self.sort_keys) == 1:
+                    self.sort_keys[i] = (column, not descending)
+                else:
+                    self.sort_keys = [(column, False)]
+                break
+        else:
+            if add:
+                self.sort_keys.append((column, False))
+            else:
+                self.sort_keys = [(column, False)]
+        self.show(self.sort_order(self.order))
+    
+    def sort_order(self, order):
+        if not self.sort_keys:
+            return order
+        if len(self.sort_keys) == 1:
+            [[column, descending]] = self.sort_keys
+            if not isinstance(self.rows, MappedRows):
+                sorted_rows = self.rows.columns[column].sorted(descending)
+                if len(order) == len(self.rows):
+                    return list(sorted_rows)
+                shown = set(order)
+                return [row for row in sorted_rows if row in shown]
+            ranks = self.ranks(column)
+            return sorted(order, key=ranks.__getitem__, reverse=descending)
+        return sorted(order, key=self.sort_key())
+    
+    def sort_key(self):
+        '''Returns a function giving the sort key of a row number'''
+        keys = [(self.ranks(column), descending)
+            for [column, descending] in self.sort_keys]
+        def key(row):
+            return tuple(-ranks[row] if descending else ranks[row]
+                for [ranks, descending] in keys)
+        return key
+    
+    def ranks(self, column):
+        if not isinstance(self.rows, MappedRows):
+            return self.rows.columns[column].ranks()
+        ranks = self.mapped_ranks.get(column)
+        if ranks is None:
+            texts = (str(self.get_values(row)[column])
+                for row in range(len(self.rows)))
+            ranks = rank_texts(texts)
+            self.mapped_ranks[column] = ranks
+        return ranks
+    
+    def filter(self, column, mode, text):
+        '''Raises ValueError or re.error for an invalid filter'''
+        narrow = text and column not in self.filters
+        if text:
+            filter_test(mode, text)  # Check before storing the filter
+            self.filters[column] = (mode, text)
+        else:
+            self.filters.pop(column, None)
+        if narrow:
+            # Only need to check the rows already shown
+            matches = set(filter_index(self.index(column), mode, text))
+            order = [row for row in self.order if row in matches]
+        else:
+            order = range(len(self.rows))
+            for [column, [mode, text]] in self.filters.items():
+                matches = set(filter_index(self.index(column), mode, text))
+                order = [row for row in order if row in matches]
+            order = self.sort_order(order)
+        self.show(order)
+    
+    def index(self, column):
+        if not isinstance(self.rows, MappedRows):
+            return self.rows.columns[column].index()
+        index = self.mapped_indexes.get(column)
+        if index is None:
+            index = dict()
+            for row in range(len(self.rows)):
+                value = str(self.get_values(row)[column])
+                index.setdefault(value, array("I")).append(row)
+            self.mapped_indexes[column] = index
+        return index
     
     def on_doubleclick(self, event):
         [region, *click] = self.click
         if region == "separator":
             [column] = click
-            width = max((self.view.min_width(item, column)
-                for item in self.view.get_children()), default=0)
+            if isinstance(self.rows, MappedRows):
+                width = max((self.view.min_width(item, column)
+                    for item in self.view.get_children()), default=0)
+            else:
+                # Only measure the few longest values
+                index = int(column.lstrip("#")) - 1
+                texts = self.rows.columns[index].widest()
+                font = Style(self.view).lookup("Treeview", "font")
+                font = tkinter.font.Font(font=font or "TkDefaultFont")
+                width = max(map(font.measure, texts), default=0)
+                width += font.measure(FIT_PADDING)
             self.view.column(column, width=width)
     
     def get_click(self, event):
@@ -105,30 +361,663 @@ class main:
             return
         Filter(self, column)
 
-class Filter:
-    def __init__(self, ui, column):
-        self.ui = ui
-        self.column = column
-        self.window = tkinter.Toplevel(self.ui.tk)
-        self.window.bind("<Return>", self.on_enter)
-        self.window.bind("<KP_Enter>", self.on_enter)
-        self.window.bind("<Escape>", self.on_escape)
-        self.window.wm_title("Filter")
-        self.entry = Entry(self.window)
-        self.entry.pack(fill=tkinter.BOTH)
-        self.entry.focus_set()
-    
-    def on_escape(self, event):
-        self.window.destroy()
-    
-    def on_enter(self, event):
-        filter = self.entry.get()
-        attached = list()
-        for item in sorted(self.ui.items):
-            if self.ui.view.set(item, self.column) == filter:
-                attached.append(item)
-        self.ui.view.set_children("", *attached)
-        self.window.destroy()
+def open_input(input=None):
+    if input is None:
+        return rewrap(stdin, newline="")
+    else:
+        return open(input, "rt", newline="")
+
+@attributes(param_types=dict(memory=int))
+def batch(input=None, *, field=(), filter=(), sort=(), memory=256):
+    '''Writes CSV to stdout with fields derived, filtered and sorted
+    
+    Same as the table window, but without Tk. Each --filter is
+    "heading=text" to match exactly, or "mode:heading=text", where
+    "mode" is one of the Filter window's modes. Each --sort is a heading,
+    prefixed with a minus sign (-) to sort in descending order. If the
+    rows to sort need more than about "memory" MiB, sorted runs are
+    written to temporary files and merged.'''
+    with open_input(input) as input, rewrap(stdout, newline="") as out:
+        reader = csv.reader(input)
+        headings = next(reader)
+        fields = list()
+        for heading in field:
+            [heading, expr] = heading.split("=", 1)
+            fields.append(Field(heading, expr, headings))
+        all_headings = headings + [field.heading for field in fields]
+        filters = list()
+        for spec in filter:
+            [mode, sep, rest] = spec.partition(":")
+            if not sep or mode not in FILTER_MODES:
+                [mode, rest] = ("equals", spec)
+            [heading, text] = rest.split("=", 1)
+            filters.append((all_headings.index(heading), mode, text))
+        sort_keys = list()
+        for heading in sort:
+            descending = heading.startswith("-") \
+                and heading not in all_headings
+            if descending:
+                heading = heading[1:]
+            sort_keys.append((all_headings.index(heading), descending))
+        def key(record):
+            return tuple(_Descending(alnum_key(record[column]))
+                if descending else alnum_key(record[column])
+                for [column, descending] in sort_keys)
+        
+        out = csv.writer(out)
+        out.writerow(all_headings)
+        with ExitStack() as cleanup:
+            runs = list()
+            records = list()
+            size = 0
+            while True:
+                store = ColumnStore(len(headings), len(fields))
+                if not store.load(islice(reader, LOAD_CHUNK), fields):
+                    break
+                rows = range(len(store))
+                for [column, mode, text] in filters:
+                    index = store.columns[column].index()
+                    matches = set(filter_index(index, mode, text))
+                    rows = [row for row in rows if row in matches]
+                if not sort_keys:
+                    out.writerows(map(store.__getitem__, rows))
+                    continue
+                for row in rows:
+                    record = store[row]
+                    records.append(record)
+                    size += sum(map(len, record)) + RECORD_OVERHEAD
+                if size > memory * 2**20:
+                    run = cleanup.enter_context(TemporaryFile("w+t",
+                        newline=""))
+                    records.sort(key=key)
+                    csv.writer(run).writerows(records)
+                    run.seek(0)
+                    runs.append(csv.reader(run))
+                    records = list()
+                    size = 0
+            records.sort(key=key)
+            if runs:
+                runs.append(records)
+                records = heapq.merge(*runs, key=key)
+            out.writerows(records)
+
+# Rough memory for each record in addition to the length of its strings
+RECORD_OVERHEAD = 200
+
+class _Descending:
+    def __init__(self, key):
+        self.key = key
+    def __lt__(self, other):
+        return other.key < self.key
+    def __eq__(self, other):
+        return self.key == other.key
+
+LOAD_CHUNK = 5000
+STREAM_BATCH = 1000
+STREAM_QUEUE = 100  # Batches read ahead of the user interface
+STREAM_INTERVAL = 0.1  # Seconds
+STREAM_POLL = 50  # Milliseconds
+
+class RowWindow:
+    '''Shows a sliding window over a long list of rows in a Tree
+    
+    Only enough items to fill the widget are created. Scrolling reassigns
+    their values, so the cost does not depend on the number of rows.
+    "Order" is the sequence of row numbers to show, and "values" is called
+    to get the values for a row number.'''
+    
+    def __init__(self, view, values):
+        self.view = view
+        self.values = values
+        self.order = range(0)
+        self.top = 0
+        self.visible = int(self.view.cget("height"))
+        self.items = list()
+        self.selected = set()  # Row numbers, kept while scrolling
+        self.cursor = 0  # Position in "order" moved by the arrow keys
+        
+        frame = self.view.master
+        self.view.grid(row=0, column=0, sticky=tkinter.NSEW)
+        frame.rowconfigure(0, weight=1)
+        frame.columnconfigure(0, weight=1)
+        self.scrollbar = Scrollbar(frame, orient=tkinter.VERTICAL,
+            command=self.yview)
+        self.scrollbar.grid(row=0, column=1, sticky=tkinter.NS)
+        horiz = Scrollbar(frame, orient=tkinter.HORIZONTAL,
+            command=self.view.xview)
+        horiz.grid(row=1, column=0, sticky=tkinter.EW)
+        self.view.configure(xscrollcommand=horiz.set)
+        
+        self.view.bind("<Configure>", self.on_configure)
+        self.view.bind("<MouseWheel>", self.on_wheel)
+        self.view.bind("<Button-4>", lambda event: self.scroll(-WHEEL_UNITS))
+        self.view.bind("<Button-5>", lambda event: self.scroll(+WHEEL_UNITS))
+        self.view.bind("<Up>", lambda event: self.move(-1))
+        self.view.bind("<Down>", lambda event: self.move(+1))
+        self.view.bind("<Prior>", lambda event: self.move(-self.visible))
+        self.view.bind("<Next>", lambda event: self.move(+self.visible))
+        self.view.bind("<<TreeviewSelect>>", self.on_select)
+        self.view.bind("<Control-Home>", lambda event: self.scroll_to(0))
+        self.view.bind("<Control-End>",
+            lambda event: self.scroll_to(len(self.order)))
+    
+    def refresh(self):
+        rows = self.order[self.top:self.top + self.visible]
+        while len(self.items) < len(rows):
+            self.items.append(self.view.add())
+        items = self.items[:len(rows)]
+        for [item, row] in zip(items, rows):
+            self.view.item(item, values=self.values(row))
+        self.view.set_children("", *items)
+        self.view.selection_set([item for [item, row] in zip(items, rows)
+            if row in self.selected])
+        # Keep the focus on the cursor, so that on_select() does not move
+        # the cursor back to an item that now shows another row
+        cursor = self.cursor - self.top
+        if 0 <= cursor < len(items):
+            self.view.focus(items[cursor])
+        else:
+            self.view.focus("")  # Root item, which on_select() ignores
+        
+        total = len(self.order)
+        if total:
+            self.scrollbar.set(self.top / total,
+                (self.top + len(rows)) / total)
+        else:
+            self.scrollbar.set(0, 1)
+    
+    def scroll_to(self, top):
+        top = min(top, len(self.order) - self.visible)
+        self.top = max(top, 0)
+        self.refresh()
+        return "break"
+    
+    def scroll(self, count):
+        return self.scroll_to(self.top + count)
+    
+    def move(self, count):
+        '''Moves the selection, scrolling to keep it in view'''
+        if not self.order:
+            return "break"
+        cursor = min(max(self.cursor + count, 0), len(self.order) - 1)
+        self.cursor = cursor
+        self.selected = {self.order[cursor]}
+        top = min(self.top, cursor)
+        top = max(top, cursor - self.visible + 1)
+        return self.scroll_to(top)
+    
+    def on_select(self, event):
+        items = self.view.get_children()
+        rows = self.order[self.top:self.top + len(items)]
+        selection = set(self.view.selection())
+        self.selected.difference_update(rows)
+        self.selected.update(row for [item, row] in zip(items, rows)
+            if item in selection)
+        focus = self.view.focus()
+        if focus in items:
+            self.cursor = self.top + items.index(focus)
+    
+    def yview(self, command, *args):
+        if command == "moveto":
+            [fraction] = args
+            self.scroll_to(round(float(fraction) * len(self.order)))
+        elif command == "scroll":
+            [count, what] = args
+            count = int(count)
+            if what == "pages":
+                count *= self.visible
+            self.scroll(count)
+    
+    def on_wheel(self, event):
+        if event.delta > 0:
+            return self.scroll(-WHEEL_UNITS)
+        else:
+            return self.scroll(+WHEEL_UNITS)
+    
+    def on_configure(self, event):
+        bbox = self.items and self.view.bbox(self.items[0])
+        if bbox:
+            [_, top, _, height] = bbox
+        else:
+            # Guess that the heading is about the same height as a row
+            font = tkinter.font.nametofont("TkDefaultFont")
+            top = height = font.metrics("linespace")
+        self.visible = max((event.height - top) // height, 1)
+        self.scroll_to(self.top)
+
+WHEEL_UNITS = 3
+FIT_PADDING = "  "
+SHIFT_MASK = 0x0001
+
+class ColumnStore:
+    '''Parsed rows, stored as a list of Column objects
+    
+    Item n is a tuple of the text of each cell in row n, for display.
+    The first columns are loaded from CSV records, and are followed by the
+    derived columns.'''
+    
+    def __init__(self, loaded, derived=0):
+        self.columns = [Column() for _ in range(loaded + derived)]
+        self.loaded = self.columns[:loaded]
+        self.derived = self.columns[loaded:]
+    
+    def load(self, records, fields):
+        '''Appends CSV records, and evaluates the fields for them'''
+        start = len(self)
+        for record in records:
+            self.append(record)
+        for [field, column] in zip(fields, self.derived):
+            column.extend(field.evaluate(self, start, len(self)))
+        return len(self) - start
+    
+    def append(self, record):
+        for [i, column] in enumerate(self.loaded):
+            if i < len(record):
+                column.append(record[i])
+            else:
+                column.append("")
+    
+    def __len__(self):
+        return len(self.loaded[0]) if self.loaded else 0
+    
+    def __getitem__(self, row):
+        return tuple(column.text(row) for column in self.columns)
+    
+    def values(self, row):
+        return [column.value(row) for column in self.loaded]
+
+class Field:
+    '''A --field expression, compiled once
+    
+    References to "row.name" become parameters of a function, so that
+    whole columns can be passed in without building a namespace per row.
+    Arithmetic and "math" functions of numeric columns are evaluated with
+    NumPy, if it is available.'''
+    
+    def __init__(self, heading, expr, headings):
+        self.heading = heading
+        self.names = dict()
+        for [i, name] in enumerate(headings):
+            self.names[name.replace(" ", "_")] = i
+        self.code = compile(expr, "--field " + heading, "eval")
+        
+        self.columns = list()
+        try:
+            body = _RowParams(self).visit(ast.parse(expr, mode="eval").body)
+        except _Unsupported:
+            self.function = None
+            self.arrays = None
+            return
+        params = [ast.arg(arg=_param(i)) for i in range(len(self.columns))]
+        params = ast.arguments(posonlyargs=[], args=params, kwonlyargs=[],
+            kw_defaults=[], defaults=[])
+        lambda_ = ast.Expression(ast.Lambda(args=params, body=body))
+        code = compile(ast.fix_missing_locations(lambda_),
+            "--field " + heading, "eval")
+        self.function = eval(code, dict(math=math))
+        
+        self.arrays = None
+        if self.columns and _is_arithmetic(body):
+            try:
+                import numpy
+            except ImportError:
+                pass
+            else:
+                self.arrays = eval(code, dict(math=_numpy_math(numpy)))
+                self.numpy = numpy
+    
+    def evaluate_row(self, values):
+        if self.function is not None:
+            return self.function(*(values[i] for i in self.columns))
+        row = SimpleNamespace()
+        for [name, i] in self.names.items():
+            setattr(row, name, values[i])
+        return eval(self.code, dict(row=row, math=math))
+    
+    def evaluate(self, store, start, stop):
+        '''Returns a sequence of values for a range of rows'''
+        if self.function is None:
+            return [self.evaluate_row(store.values(row))
+                for row in range(start, stop)]
+        if not self.columns:
+            # map() needs at least one column
+            return [self.function() for _ in range(start, stop)]
+        columns = [store.loaded[i] for i in self.columns]
+        numeric = all(column.is_numeric(start, stop) for column in columns)
+        if numeric and self.arrays is not None and stop > start:
+            arrays = (self.numpy.frombuffer(column.numbers[start:stop])
+                for column in columns)
+            with self.numpy.errstate(all="ignore"):
+                result = self.arrays(*arrays)
+            # Let the Python version raise exceptions like ZeroDivisionError
+            if self.numpy.isfinite(result).all():
+                values = array("d")
+                values.frombytes(result.astype("d").tobytes())
+                return values
+        columns = [column.numbers[start:stop] if numeric
+            else column.values(start, stop) for column in columns]
+        return list(map(self.function, *columns))
+
+class _RowParams(ast.NodeTransformer):
+    def __init__(self, field):
+        self.field = field
+    
+    def visit_Attribute(self, node):
+        if not isinstance(node.value, ast.Name) or node.value.id != "row":
+            return self.generic_visit(node)
+        if not isinstance(node.ctx, ast.Load) \
+                or node.attr not in self.field.names:
+            raise _Unsupported()
+        column = self.field.names[node.attr]
+        if column not in self.field.columns:
+            self.field.columns.append(column)
+        param = _param(self.field.columns.index(column))
+        return ast.copy_location(ast.Name(id=param, ctx=ast.Load()), node)
+    
+    def visit_Name(self, node):
+        if node.id == "row" or node.id.startswith("_row_"):
+            raise _Unsupported()
+        return node
+
+class _Unsupported(Exception):
+    pass
+
+def _param(i):
+    return "_row_{}".format(i)
+
+def _is_arithmetic(node):
+    if isinstance(node, ast.BinOp):
+        return isinstance(node.op, _ARITHMETIC_OPS) \
+            and _is_arithmetic(node.left) and _is_arithmetic(node.right)
+    if isinstance(node, ast.UnaryOp):
+        return isinstance(node.op, (ast.UAdd, ast.USub)) \
+            and _is_arithmetic(node.operand)
+    if isinstance(node, ast.Constant):
+        return type(node.value) in {int, float}
+    if isinstance(node, ast.Name):
+        return node.id.startswith("_row_")
+    if isinstance(node, ast.Attribute):
+        return isinstance(node.value, ast.Name) and node.value.id == "math" \
+            and node.attr in _MATH_CONSTANTS
+    if isinstance(node, ast.Call):
+        func = node.func
+        return isinstance(func, ast.Attribute) \
+            and isinstance(func.value, ast.Name) and func.value.id == "math" \
+            and func.attr in _MATH_FUNCTIONS and not node.keywords \
+            and all(map(_is_arithmetic, node.args))
+    return False
+
+_ARITHMETIC_OPS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv,
+    ast.Mod, ast.Pow)
+_MATH_CONSTANTS = {"pi", "e", "tau"}
+# Functions that return floats for float arguments, like NumPy's versions
+_MATH_FUNCTIONS = {
+    "sqrt": "sqrt", "exp": "exp", "log10": "log10", "log2": "log2",
+    "sin": "sin", "cos": "cos", "tan": "tan", "fabs": "fabs",
+    "hypot": "hypot",
+}
+
+def _numpy_math(numpy):
+    ns = {name: getattr(math, name) for name in _MATH_CONSTANTS}
+    for [name, func] in _MATH_FUNCTIONS.items():
+        ns[name] = getattr(numpy, func)
+    return SimpleNamespace(**ns)
+
+class Column:
+    '''Values of one column, with one entry in each array per row
+    
+    Cells that parse as numbers are stored as floats. Their text is
+    regenerated from the float when possible, otherwise it is stored,
+    like the text of other cells, as a code into a list of the distinct
+    strings of the column.'''
+    
+    def __init__(self):
+        self.numbers = array("d")
+        # 0: text only; 1: number and text; 2: number shown with repr();
+        # 3 and up: optional dollar sign and number of decimal places
+        self.styles = bytearray()
+        self.codes = array("I")
+        self.strings = list()
+        self._codes = dict()
+        self._ranks = None
+        self._sorted = dict()
+        self._index = None
+        self._index_length = 0
+        self._widest = list()
+        self._widest_rows = 0
+        self._widest_strings = 0
+    
+    def __len__(self):
+        return len(self.styles)
+    
+    def ranks(self):
+        '''Returns the position of each row's text in sorted order
+        
+        Equal text gets equal rank. Computed on first use, and again if
+        rows have been added since.'''
+        if self._ranks is None or len(self._ranks) != len(self):
+            self._ranks = rank_texts(map(self.text, range(len(self))))
+            self._sorted.clear()
+        return self._ranks
+    
+    def index(self):
+        '''Returns a dictionary of the rows with each distinct text'''
+        if self._index is None or self._index_length != len(self):
+            self._index = dict()
+            for row in range(len(self)):
+                self._index.setdefault(self.text(row), array("I")).append(row)
+            self._index_length = len(self)
+        return self._index
+    
+    def widest(self, count=5):
+        '''Returns the longest few distinct texts in the column
+        
+        Only rows added since the last call are checked.'''
+        if self._widest_rows < len(self):
+            rows = range(self._widest_rows, len(self))
+            numbers = (self.text(row) for row in rows if self.styles[row] >= 2)
+            strings = self.strings[self._widest_strings:]
+            texts = set(self._widest)
+            texts.update(numbers, strings)
+            self._widest = heapq.nlargest(count, texts, key=len)
+            self._widest_rows = len(self)
+            self._widest_strings = len(self.strings)
+        return self._widest
+    
+    def sorted(self, descending=False):
+        '''Returns all row numbers, stably sorted by text'''
+        ranks = self.ranks()
+        order = self._sorted.get(descending)
+        if order is None:
+            order = sorted(range(len(ranks)), key=ranks.__getitem__,
+                reverse=descending)
+            order = array("I", order)
+            self._sorted[descending] = order
+        return order
+    
+    def append(self, text):
+        value = parse_value(text)
+        if isinstance(value, str):
+            self._append_text(text)
+            return
+        [dollar, number] = split_dollar(text)
+        [_, point, fraction] = number.partition(".")
+        if point and fraction.isdecimal():
+            places = len(fraction)
+        else:
+            places = 0
+        style = 3 + places * 2 + bool(dollar)
+        if style <= 255 and _format_number(style, value) == text:
+            self._append_number(value, style)
+        else:
+            self._append_number(value, 1, text)
+    
+    def extend(self, values):
+        if not isinstance(values, array):
+            for value in values:
+                self.append_value(value)
+            return
+        self.numbers.extend(values)
+        self.styles.extend(bytes((2,)) * len(values))
+        self.codes.frombytes(bytes(self.codes.itemsize * len(values)))
+    
+    def is_numeric(self, start, stop):
+        return 0 not in self.styles[start:stop]
+    
+    def values(self, start, stop):
+        return [self.value(row) for row in range(start, stop)]
+    
+    def append_value(self, value):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            self._append_text(str(value))
+        elif isinstance(value, float):
+            self._append_number(value, 2)
+        else:
+            self._append_number(float(value), 1, str(value))
+    
+    def _append_text(self, text):
+        self.numbers.append(math.nan)
+        self.styles.append(0)
+        self.codes.append(self._encode(text))
+    
+    def _append_number(self, number, style, text=None):
+        self.numbers.append(number)
+        self.styles.append(style)
+        if text is None:
+            self.codes.append(0)
+        else:
+            self.codes.append(self._encode(text))
+    
+    def _encode(self, text):
+        code = self._codes.get(text)
+        if code is None:
+            code = len(self.strings)
+            self.strings.append(text)
+            self._codes[text] = code
+        return code
+    
+    def text(self, row):
+        style = self.styles[row]
+        if style < 2:
+            return self.strings[self.codes[row]]
+        return _format_number(style, self.numbers[row])
+    
+    def value(self, row):
+        if self.styles[row]:
+            return self.numbers[row]
+        return self.strings[self.codes[row]]
+
+def rank_texts(texts):
+    '''Ranks a sequence of strings by alnum_key()
+    
+    The key is only computed once for each distinct string.'''
+    texts = list(texts)
+    distinct = sorted(set(texts), key=alnum_key)
+    ranks = dict(zip(distinct, range(len(distinct))))
+    return array("I", map(ranks.__getitem__, texts))
+
+def _format_number(style, number):
+    if style == 2:
+        return repr(number)
+    [places, dollar] = divmod(style - 3, 2)
+    return "$" * dollar + format(number, ".{}f".format(places))
+
+def parse_value(text):
+    '''Returns a float if the text is a number, otherwise the text'''
+    [_, num] = split_dollar(text)
+    try:
+        return float(num)
+    except ValueError:
+        return text
+
+def split_dollar(text):
+    if text.startswith("$"):
+        return ("$", text[1:])
+    return ("", text)
+
+class MappedRows:
+    '''Random access to the records of a CSV file through "mmap"
+    
+    An index of record offsets is cached next to the file, and rebuilt
+    when the file's size or modification time changes. Item n is the
+    list of fields for the record after the heading row.'''
+    
+    def __init__(self, path, encoding):
+        self.encoding = encoding
+        with open(path, "rb") as file:
+            self.offsets = load_row_index(path, file)
+            if os.fstat(file.fileno()).st_size:
+                self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:  # Cannot map an empty file
+                self.map = b""
+    
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+    
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+    
+    def __len__(self):
+        return max(len(self.offsets) - 2, 0)
+    
+    def __getitem__(self, row):
+        if not 0 <= row < len(self):
+            raise IndexError(row)
+        record = self.map[self.offsets[row + 1]:self.offsets[row + 2]]
+        record = record.decode(self.encoding)
+        return next(csv.reader((record,)), [])
+
+def load_row_index(path, file):
+    '''Returns the start offset of each record, followed by the file size'''
+    cache = path + os.extsep + "rowidx"
+    stat = os.fstat(file.fileno())
+    try:
+        with open(cache, "rb") as reader:
+            offsets = array("Q")
+            offsets.fromfile(reader, 2)
+            if list(offsets) == [stat.st_size, stat.st_mtime_ns]:
+                offsets = array("Q")
+                offsets.frombytes(reader.read())
+                return offsets
+    except (FileNotFoundError, EOFError):
+        pass
+    
+    offsets = index_rows(file)
+    [dir, name] = os.path.split(cache)
+    try:
+        new = NamedTemporaryFile(delete=False,
+            dir=dir or os.curdir, prefix=name + "~")
+        try:
+            with new:
+                array("Q", (stat.st_size, stat.st_mtime_ns)).tofile(new)
+                offsets.tofile(new)
+            os.replace(new.name, cache)
+        except:
+            os.unlink(new.name)
+            raise
+    except OSError as err:
+        warn("Row index not cached: {}".format(err))
+    return offsets
+
+def index_rows(file):
+    '''Finds record boundaries in one pass over a binary CSV file
+    
+    Line breaks inside quoted fields do not end a record. Assumes an
+    ASCII-compatible encoding.'''
+    offsets = array("Q")
+    offset = 0
+    quoted = False
+    for line in file:
+        if not quoted:
+            offsets.append(offset)
+        if line.count(b'"') % 2:
+            quoted = not quoted
+        offset += len(line)
+    offsets.append(offset)
+    return offsets
 
 def alnum_key(value):
     '''
@@ -143,31 +1032,26 @@ def alnum_key(value):
     >>> alnum_key("1 a") < alnum_key("1b") < alnum_key("1 c")
     True
     '''
-    numbers = list()
-    i = 0
-    while i < len(value):
-        if value[i].isdecimal() or value[i] == ".":
-            start = i
-            while value[i:i + 1] == "," or value[i:i + 1].isdecimal():
-                i += 1
-            whole = value[start:i].translate(_DROP_COMMAS)
-            start = i
-            if value[i:i + 1] == ".":
-                while True:
-                    i += 1
-                    if not value[i:i + 1].isdecimal():
-                        break
-            if whole:
-                whole = int(whole)
-            else:
-                whole = 0
-            numbers.append(("0", whole, value[start:i]))
-            while value[i:i + 1].isspace():
-                i += 1
-        else:
-            numbers.append((value[i],))
-            i += 1
-    return (numbers, value)
+    # Each number is encoded so that it sorts in the right place among
+    # other characters, and compares with other numbers by value
+    return (_NUMBER.sub(_encode_number, value), value)
+
+# Digits and commas, or nothing if starting with a decimal point; then an
+# optional decimal point and fraction; then any trailing space
+_NUMBER = re.compile(r"(\d[\d,]*|(?=\.))(\.\d*)?\s*")
+
+def _encode_number(match):
+    [whole, fraction] = match.groups()
+    if not whole:
+        whole = "0"
+    elif whole.isascii():
+        whole = whole.replace(",", "").lstrip("0") or "0"
+    else:
+        whole = str(int(whole.translate(_DROP_COMMAS)))
+    # "0" sorts numbers between other characters, then the length and
+    # digits order the whole part. The fraction is terminated by a null
+    # so that a shorter fraction sorts first.
+    return "".join(("0", chr(len(whole)), whole, fraction or "", "\0"))
 
 _DROP_COMMAS = str.maketrans({",": ""})
 